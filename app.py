@@ -1,30 +1,113 @@
-from quart import Quart, request, after_this_request
+from quart import Quart, Response, request, after_this_request, g
 from json import dumps as jsonify
 import json
 import asyncio
+import time
 from tqdm.auto import tqdm
 
 from src.telegram import Telegram
 from src.database import Database
-from src.chunker import Chunker
+from src.chunker import Chunker, ContentDefinedChunker
+from src.downloader import Downloader
+from src.cache import Cache
+from src.directory_tree import DirectoryTree
+from src.json_provider import JSONProvider
+from src.jobs import Jobs
+from src.uploads import Uploads
+from src.reaper import Reaper
+from src.compression import Compressor
+from src.packs import Packer
+from src.transfers import Transfers
 
 import src.handlers.files as handlers_files
 import src.handlers.directories as handlers_directories
 import src.handlers.tags as handlers_tags
+import src.handlers.jobs as handlers_jobs
+import src.handlers.uploads as handlers_uploads
+import src.handlers.transfers as handlers_transfers
 
+import src.indexes as indexes
 import src.utils as utils
+import src.metrics as metrics
 
 
 telegram = Telegram()
-db = Database().db
+db = Database([metrics.CommandListener()]).db
 
 telegram_max_file_size = telegram.max_file_size
-chunker = Chunker(telegram_max_file_size)
+chunker = ContentDefinedChunker(telegram.cdc_average_size, telegram_max_file_size) if telegram.chunking == "cdc" else Chunker(telegram_max_file_size)
+cache = Cache()
+compressor = Compressor()
+downloader = Downloader(telegram, cache, telegram.download_window, telegram.download_block_size)
+tree = DirectoryTree()
+packer = Packer(db, telegram, cache)
+transfers = Transfers()
+jobs = Jobs(db, telegram, chunker, cache, compressor, packer, transfers)
+uploads = Uploads(db, telegram, cache)
+reaper = Reaper(db, telegram)
 
 utils.clear_temp_folder()
 
 app = Quart(__name__)
+app.json = JSONProvider(app)  # ObjectId and datetime are encoded while serializing, without a copy of the response
 app.config["MAX_CONTENT_LENGTH"] = 1024 * 1024 * 1024 * 2 * 10  # 20 GB
+app.config["BODY_TIMEOUT"] = None  # large uploads take longer than the default 60 seconds to receive
+app.config["RESPONSE_TIMEOUT"] = None  # streamed downloads last as long as the transfer from Telegram
+
+
+@app.before_serving
+async def migrate_indexes():
+    await indexes.migrate(db)
+
+
+@app.before_serving
+async def load_directory_tree():
+    await tree.load(db)
+
+
+@app.before_serving
+async def update_tags_ancestors():
+    await handlers_tags.update_tags_ancestors(db)
+
+
+@app.before_serving
+async def start_jobs():
+    await jobs.start()
+
+
+@app.before_serving
+async def start_reaper():
+    reaper.start()
+
+
+@app.before_serving
+async def start_packer():
+    packer.start()
+
+
+@app.before_serving
+async def start_uploads():
+    uploads.start()
+
+
+@app.after_serving
+async def stop_jobs():
+    await jobs.stop()
+
+
+@app.after_serving
+async def stop_reaper():
+    await reaper.stop()
+
+
+@app.after_serving
+async def stop_packer():
+    await packer.stop()
+
+
+@app.after_serving
+async def stop_uploads():
+    await uploads.stop()
 
 
 @app.route('/', methods=['GET'])
@@ -32,11 +115,51 @@ async def test_connection():
     return "Connection established", 200
 
 
+@app.before_request
+async def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.handler.set(request.endpoint or "unmatched")
+
+
+@app.after_request
+async def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    metrics.observe("http_request_duration_seconds", time.perf_counter() - g.request_started, method=request.method, route=route, status=response.status_code)
+    return response
+
+
+def collect_metrics():
+    paths = {"temp": "temp", "jobs": jobs.path, "uploads": uploads.path}
+    buckets = telegram.scheduler.buckets.items()
+    return [
+        ("disk_usage_bytes", "gauge", "Local disk used by temporary files, spooled jobs, resumable uploads and the chunk cache", [({"folder": name}, utils.get_folder_size(path)) for name, path in paths.items()] + [({"folder": "cache"}, cache.disk_size)]),
+        ("cache_events_total", "counter", "Chunk cache hits, misses and evictions", [({"event": event}, count) for event, count in cache.stats().items() if event in cache.counters]),
+        ("telegram_calls_queued", "gauge", "Telegram calls waiting in the scheduler", [({"session": session, "method": method}, len(bucket.waiters)) for (session, method), bucket in buckets]),
+        ("telegram_flood_waits_total", "counter", "FloodWaits returned by Telegram", [({"session": session, "method": method}, bucket.flood_waits) for (session, method), bucket in buckets]),
+        ("deletions_total", "counter", "Telegram messages deleted by the reaper", [({}, reaper.deleted)]),
+    ]
+
+
+metrics.register(collect_metrics)
+
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route('/stats', methods=['GET'])
+async def get_stats():
+    return {"downloads": downloader.stats(), "sessions": telegram.stats(), "cache": cache.stats(), "deletions": reaper.stats(), "scheduler": telegram.scheduler.stats()}, 200
+
+
 @app.route('/files', methods=['GET'])
 async def download_files():
     tags = request.args.getlist('tags')
     file_types = request.args.getlist('types')
     directories = request.args.getlist('directories')
+    if request.args.get('descendants'):
+        tags = await handlers_tags.get_tags_with_descendants(db, tags)
 
     files, code = await handlers_files.get_files(db, tags=tags, file_types=file_types, directories=directories)
     file_ids = [file["_id"] for file in files]
@@ -44,7 +167,7 @@ async def download_files():
     if not file_ids:
         return "No files found", 404
 
-    return await handlers_files.download_files(file_ids, db, telegram, chunker)
+    return await handlers_files.download_files(file_ids, db, telegram, downloader, tree, transfers)
 
 
 @app.route('/files', methods=['POST'])
@@ -55,7 +178,12 @@ async def upload_files():
     form_data = await request.form
     data = form_data.getlist("data")
 
-    return await handlers_files.upload_files(files, data, db, telegram, chunker)
+    # Spooled to disk and uploaded in the background, the client polls /jobs/<job_id>
+    if request.args.get('async'):
+        return await handlers_jobs.create_upload_job(files, data, jobs)
+
+    # The client picks the transfer id, so it can follow /transfers/<id>/events while the upload runs
+    return await handlers_files.upload_files(files, data, db, telegram, chunker, cache, compressor, packer, transfers, request.args.get('transfer'))
 
 
 @app.route('/files', methods=['DELETE'])
@@ -63,6 +191,8 @@ async def delete_files():
     tags = request.args.getlist('tags')
     file_types = request.args.getlist('types')
     directories = request.args.getlist('directories')
+    if request.args.get('descendants'):
+        tags = await handlers_tags.get_tags_with_descendants(db, tags)
 
     files, code = await handlers_files.get_files(db, tags=tags, file_types=file_types, directories=directories)
     file_ids = [file["_id"] for file in files]
@@ -74,8 +204,15 @@ async def get_files_ids():
     tags = request.args.getlist('tags')
     file_types = request.args.getlist('types')
     directories = request.args.getlist('directories')
-
-    files, code = await handlers_files.get_files(db, tags=tags, file_types=file_types, directories=directories)
+    if request.args.get('descendants'):
+        tags = await handlers_tags.get_tags_with_descendants(db, tags)
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    stream = request.accept_mimetypes.best == "application/x-ndjson"
+
+    files, code = await handlers_files.get_files(db, tags=tags, file_types=file_types, directories=directories, limit=limit, after=after, fields=["_id"], stream=stream)
+    if stream or code != 200:
+        return files, code
     file_ids = [file["_id"] for file in files]
 
     return file_ids, 200
@@ -86,82 +223,89 @@ async def get_files():
     tags = request.args.getlist('tags')
     file_types = request.args.getlist('types')
     directories = request.args.getlist('directories')
+    if request.args.get('descendants'):
+        tags = await handlers_tags.get_tags_with_descendants(db, tags)
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    fields = request.args.getlist('fields')
+    stream = request.accept_mimetypes.best == "application/x-ndjson"
 
-    return await handlers_files.get_files(db, tags=tags, file_types=file_types, directories=directories)
+    return await handlers_files.get_files(db, tags=tags, file_types=file_types, directories=directories, limit=limit, after=after, fields=fields, stream=stream)
 
 
 @app.route('/files/meta', methods=['PATCH'])
 async def patch_files():
     tags = request.args.getlist('tags')
     file_types = request.args.getlist('types')
-    directories = request.args.get('directories')
+    directories = request.args.getlist('directories')
+    if request.args.get('descendants'):
+        tags = await handlers_tags.get_tags_with_descendants(db, tags)
 
     form = await request.form
     new_tags = form.getlist("tags")
     new_directory = form.get("directory")
 
-    files, code = await handlers_files.get_files(db, tags=tags, file_types=file_types, directories=directories)
-    file_ids = [file["_id"] for file in files]
-    return await handlers_files.patch_files(file_ids, db, telegram, new_tags=new_tags, new_directory=new_directory)
+    query = handlers_files.get_files_query(tags, file_types, directories)
+    return await handlers_files.patch_files(query, db, telegram, new_tags=new_tags, new_directory=new_directory)
 
 
 @app.route('/files/meta/tags', methods=['POST'])
 async def add_tags_to_files():
     tags = request.args.getlist('tags')
     file_types = request.args.getlist('types')
-    directories = request.args.get('directories')
+    directories = request.args.getlist('directories')
+    if request.args.get('descendants'):
+        tags = await handlers_tags.get_tags_with_descendants(db, tags)
 
     form = await request.form
     tags_to_add = form.getlist("tags")
 
-    files, code = await handlers_files.get_files(db, tags=tags, file_types=file_types, directories=directories)
-    file_ids = [file["_id"] for file in files]
-    return await handlers_files.add_tags_to_files(file_ids, db, tags_to_add, telegram)
+    query = handlers_files.get_files_query(tags, file_types, directories)
+    return await handlers_files.add_tags_to_files(query, db, tags_to_add, telegram)
 
 
 @app.route('/files/meta/tags', methods=['PATCH'])
 async def remove_tags_in_files():
     tags = request.args.getlist('tags')
     file_types = request.args.getlist('types')
-    directories = request.args.get('directories')
+    directories = request.args.getlist('directories')
+    if request.args.get('descendants'):
+        tags = await handlers_tags.get_tags_with_descendants(db, tags)
 
     form = await request.form
     tags_to_remove = form.getlist("tags")
 
-    files, code = await handlers_files.get_files(db, tags=tags, file_types=file_types, directories=directories)
-    file_ids = [file["_id"] for file in files]
-    return await handlers_files.remove_tags_from_files(file_ids, db, tags_to_remove, telegram)
+    query = handlers_files.get_files_query(tags, file_types, directories)
+    return await handlers_files.remove_tags_from_files(query, db, tags_to_remove, telegram)
 
 
 @app.route('/files/meta/tags', methods=['DELETE'])
 async def delete_all_tags_in_files():
     tags = request.args.getlist('tags')
     file_types = request.args.getlist('types')
-    directories = request.args.get('directories')
+    directories = request.args.getlist('directories')
+    if request.args.get('descendants'):
+        tags = await handlers_tags.get_tags_with_descendants(db, tags)
 
-    files, code = await handlers_files.get_files(db, tags=tags, file_types=file_types, directories=directories)
-    file_ids = [file["_id"] for file in files]
-    return await handlers_files.delete_all_tags_from_files(file_ids, db, telegram)
+    query = handlers_files.get_files_query(tags, file_types, directories)
+    return await handlers_files.delete_all_tags_from_files(query, db, telegram)
 
 
 @app.route('/files/meta/directory', methods=['DELETE'])
 async def delete_files_directory():
     tags = request.args.getlist('tags')
     file_types = request.args.getlist('types')
-    directories = request.args.get('directories')
+    directories = request.args.getlist('directories')
+    if request.args.get('descendants'):
+        tags = await handlers_tags.get_tags_with_descendants(db, tags)
 
-    files, code = await handlers_files.get_files(db, tags=tags, file_types=file_types, directories=directories)
-    file_ids = [file["_id"] for file in files]
-    return await handlers_files.delete_files_directory(file_ids, db, telegram)
+    query = handlers_files.get_files_query(tags, file_types, directories)
+    return await handlers_files.delete_files_directory(query, db, telegram)
 
 
 @app.route('/files/<file_id>', methods=['GET'])
 async def download_file(file_id):
-    response, code = await handlers_files.download_file(file_id, db, telegram, chunker)
-    if code == 404:
-        return "File not found", 404
-
-    return await handlers_files.send_single_file(response)
+    return await handlers_files.stream_file(file_id, db, telegram, downloader, transfers, range_=request.range, if_range=request.if_range)
 
 
 @app.route('/files/<file_id>', methods=['DELETE'])
@@ -222,7 +366,7 @@ async def download_directories():
     files, code = await handlers_files.get_files(db, directories=directories_ids)
     files_ids = [file["_id"] for file in files]
 
-    return await handlers_files.download_files(files_ids, db, telegram, chunker)
+    return await handlers_files.download_files(files_ids, db, telegram, downloader, tree, transfers)
 
 
 @app.route('/directories', methods=['POST'])
@@ -230,7 +374,7 @@ async def create_directory():
     form = await request.form
     name = form.get("name")
     parent = form.get("parent")
-    return await handlers_directories.create_directory(db, name, parent)
+    return await handlers_directories.create_directory(db, name, parent, tree)
 
 
 @app.route('/directories', methods=['DELETE'])
@@ -241,7 +385,7 @@ async def delete_directories():
 
     directories, code = await handlers_directories.get_directories(db, names=names, parents=parents, recursive=recursive)
     directories_ids = [directory["_id"] for directory in directories]
-    return await handlers_directories.delete_directories(directories_ids, db, telegram)
+    return await handlers_directories.delete_directories(directories_ids, db, telegram, tree)
 
 
 @app.route('/directories/id', methods=['GET'])
@@ -260,7 +404,11 @@ async def get_directories_ids():
 async def get_directories():
     names = request.args.getlist('names')
     parents = request.args.getlist('parents')
-    return await handlers_directories.get_directories(db, names=names, parents=parents)
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    fields = request.args.getlist('fields')
+    stream = request.accept_mimetypes.best == "application/x-ndjson"
+    return await handlers_directories.get_directories(db, names=names, parents=parents, limit=limit, after=after, fields=fields, stream=stream)
 
 
 @app.route('/directories/meta', methods=['PATCH'])
@@ -274,7 +422,7 @@ async def patch_directories():
 
     directories, code = await handlers_directories.get_directories(db, names=names, parents=parents)
     directories_ids = [directory["_id"] for directory in directories]
-    return await handlers_directories.patch_directories(directories_ids, db, telegram, new_name=new_name, new_parent=new_parent)
+    return await handlers_directories.patch_directories(directories_ids, db, telegram, tree, new_name=new_name, new_parent=new_parent)
 
 
 @app.route('/directories/<directory_id>', methods=['GET'])
@@ -286,12 +434,12 @@ async def download_directory(directory_id):
     files, code = await handlers_files.get_files(db, directories=[directory_id])
     files_ids = [file["_id"] for file in files]
 
-    return await handlers_files.download_files(files_ids, db, telegram, chunker)
+    return await handlers_files.download_files(files_ids, db, telegram, downloader, tree, transfers)
 
 
 @app.route('/directories/<directory_id>', methods=['DELETE'])
 async def delete_directory(directory_id):
-    return await handlers_directories.delete_directory(directory_id, db, telegram)
+    return await handlers_directories.delete_directory(directory_id, db, telegram, tree)
 
 
 @app.route('/directories/<directory_id>/meta', methods=['GET'])
@@ -305,7 +453,7 @@ async def patch_directory(directory_id):
     name = form.get("name")
     parent = form.get("parent")
 
-    return await handlers_directories.patch_directory(directory_id, db, telegram, new_name=name, new_parent=parent)
+    return await handlers_directories.patch_directory(directory_id, db, telegram, tree, new_name=name, new_parent=parent)
 
 
 @app.route('/directories/<directory_id>/meta/children', methods=['GET'])
@@ -320,7 +468,7 @@ async def add_directory_children(directory_id):
     form = await request.form
     directories = form.getlist("directories")
 
-    return await handlers_directories.add_directory_children(directory_id, db, directories)
+    return await handlers_directories.add_directory_children(directory_id, db, directories, tree)
 
 
 @app.route('/directories/<directory_id>/meta/children', methods=['PUT'])
@@ -329,7 +477,7 @@ async def remove_directory_children(directory_id):
     directories = form.getlist("directories")
     recursive = request.args.get('recursive')
 
-    return await handlers_directories.remove_directory_children(directory_id, db, directories, recursive=recursive)
+    return await handlers_directories.remove_directory_children(directory_id, db, directories, tree, recursive=recursive)
 
 
 @app.route('/tags', methods=['GET'])
@@ -337,7 +485,11 @@ async def get_tags():
     names = request.args.getlist('names')
     parents = request.args.getlist('parents')
     recursive = request.args.get('recursive')
-    return await handlers_tags.get_tags(db, names=names, parents=parents, recursive=recursive)
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    fields = request.args.getlist('fields')
+    stream = request.accept_mimetypes.best == "application/x-ndjson"
+    return await handlers_tags.get_tags(db, names=names, parents=parents, recursive=recursive, limit=limit, after=after, fields=fields, stream=stream)
 
 
 @app.route('/tags', methods=['POST'])
@@ -405,24 +557,56 @@ async def remove_tag_children(tag_id):
     return await handlers_tags.remove_tag_children(tag_id, db, telegram, recursive=recursive)
 
 
-@app.route('/structure/directories', methods=['GET'])
-async def get_directories_structure():
-    directories, code = await handlers_directories.get_directories(db)
+@app.route('/uploads', methods=['POST'])
+async def create_upload():
+    form = await request.form
+    name = form.get("name")
+    data = form.get("data")
+    size = form.get("size")
 
-    structure = {}
-    for directory in directories:
-        if directory["parent"] is None:
-            structure[f"/{directory['name']}"] = directory["_id"]
-        else:
-            parent = directory["parent"]
-            path = f"/{directory['name']}"
-            while parent is not None:
-                parent_directory, code = await handlers_directories.get_directory(db, parent)
-                path = f"/{parent_directory['name']}{path}"
-                parent = parent_directory["parent"]
-
-            structure[path] = directory["_id"]
+    return await handlers_uploads.create_upload(name, data, size, db, uploads)
+
+
+@app.route('/uploads/<upload_id>', methods=['GET'])
+async def get_upload(upload_id):
+    return await handlers_uploads.get_upload(upload_id, uploads)
+
+
+@app.route('/uploads/<upload_id>', methods=['PATCH'])
+async def patch_upload(upload_id):
+    offset = request.headers.get("Upload-Offset")
+
+    return await handlers_uploads.patch_upload(upload_id, offset, request.body, uploads)
+
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+async def finalize_upload(upload_id):
+    return await handlers_uploads.finalize_upload(upload_id, db, telegram, uploads)
+
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+async def delete_upload(upload_id):
+    return await handlers_uploads.delete_upload(upload_id, db, telegram, uploads)
 
+
+@app.route('/transfers/<transfer_id>', methods=['GET'])
+async def get_transfer(transfer_id):
+    return await handlers_transfers.get_transfer(transfer_id, transfers)
+
+
+@app.route('/transfers/<transfer_id>/events', methods=['GET'])
+async def get_transfer_events(transfer_id):
+    return await handlers_transfers.get_transfer_events(transfer_id, transfers)
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+async def get_job(job_id):
+    return await handlers_jobs.get_job(job_id, jobs)
+
+
+@app.route('/structure/directories', methods=['GET'])
+async def get_directories_structure():
+    structure = {f"/{path[:-1]}": directory_id for directory_id, path in tree.paths().items() if directory_id is not None}
     structure["/"] = '/'
     return structure, 200
 
@@ -431,18 +615,10 @@ async def get_directories_structure():
 async def get_files_structure():
     structure = {}
 
-    files, code = await handlers_files.get_files(db)
-    for file in files:
-        path = f"/{file['name']}"
-        directory_id = file["directory"]
-        while directory_id is not None:
-            directory, code = await handlers_directories.get_directory(db, directory_id)
-            if code != 200:
-                return
-            path = f"/{directory['name']}{path}"
-            directory_id = directory["parent"] if directory["parent"] is not None else None
-
-        structure[path] = file["_id"]
+    paths = tree.paths()
+    async for file in db["files"].find({}, {"name": 1, "directory": 1}):
+        path = paths.get(str(file["directory"]) if file["directory"] else None, "")
+        structure[f"/{path}{file['name']}"] = str(file["_id"])
     return structure, 200
 
 
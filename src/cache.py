@@ -0,0 +1,163 @@
+import asyncio
+import collections
+import hashlib
+import os
+from yaml import safe_load
+
+
+class Cache:
+    def __init__(self):
+        with open("config.yaml", "r") as config_file:
+            config = safe_load(config_file)
+
+        self.path = config.get("cache_path", "cache")
+        self.max_size = config.get("cache_max_size", 0)
+        self.memory_max_size = config.get("cache_memory_max_size", 64 * 1024 * 1024)
+        self.memory_max_item_size = config.get("cache_memory_max_item_size", 1024 * 1024)
+        self.max_partials = config.get("cache_max_partials", 16)
+
+        self.memory = collections.OrderedDict()
+        self.memory_size = 0
+        self.disk = collections.OrderedDict()
+        self.disk_size = 0
+        self.partials = collections.OrderedDict()
+
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "memory_evictions": 0, "disk_evictions": 0}
+
+        self.load()
+
+    def stats(self):
+        return {
+            **self.counters,
+            "memory_size": self.memory_size,
+            "memory_items": len(self.memory),
+            "disk_size": self.disk_size,
+            "disk_items": len(self.disk),
+        }
+
+    def load(self):
+        # The disk tier survives restarts, the LRU order is rebuilt from modification times
+        os.makedirs(self.path, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name.endswith(".part"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+
+        for mtime, name, size in sorted(entries):
+            self.disk[name] = size
+            self.disk_size += size
+        self.evict_disk()
+
+    def file_path(self, name, partial=False):
+        return os.path.join(self.path, name + (".part" if partial else ""))
+
+    @staticmethod
+    def name(key):
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def get(self, key, offset, length):
+        name = self.name(key)
+
+        data = self.memory.get(name)
+        if data is not None:
+            self.memory.move_to_end(name)
+            self.counters["memory_hits"] += 1
+            return data[offset:offset + length]
+
+        if name in self.disk:
+            path = self.file_path(name)
+            with open(path, "rb") as file:
+                file.seek(offset)
+                data = file.read(length)
+            os.utime(path)
+            self.disk.move_to_end(name)
+            self.counters["disk_hits"] += 1
+            return data
+
+        self.counters["misses"] += 1
+        return None
+
+    def put_memory(self, name, data):
+        if len(data) > self.memory_max_item_size or name in self.memory:
+            return
+
+        self.memory[name] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.memory_max_size:
+            evicted_name, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+            self.counters["memory_evictions"] += 1
+
+    def commit(self, name, size):
+        os.replace(self.file_path(name, partial=True), self.file_path(name))
+        self.disk[name] = size
+        self.disk_size += size
+        self.evict_disk()
+
+    def evict_disk(self):
+        while self.disk_size > self.max_size and self.disk:
+            name, size = self.disk.popitem(last=False)
+            os.remove(self.file_path(name))
+            self.disk_size -= size
+            self.counters["disk_evictions"] += 1
+
+    def cacheable(self, name, size):
+        return name not in self.disk and size <= self.max_size
+
+    async def put_stream(self, key, stream, size):
+        # Filled on upload, copied in small pieces so the event loop and the concurrent chunk uploads keep running
+        name = self.name(key)
+        if size <= self.memory_max_item_size:
+            stream.seek(0)
+            self.put_memory(name, stream.read(size))
+
+        if not self.cacheable(name, size):
+            return
+
+        stream.seek(0)
+        with open(self.file_path(name, partial=True), "wb") as file:
+            while True:
+                data = stream.read(1024 * 1024)
+                if not data:
+                    break
+                file.write(data)
+                await asyncio.sleep(0)
+        self.commit(name, size)
+
+    def put_block(self, key, size, offset, data, block_size):
+        # Filled on download, a chunk is committed once every aligned block of it has been fetched
+        name = self.name(key)
+        if offset == 0 and len(data) == size:
+            self.put_memory(name, data)
+
+        if not self.cacheable(name, size) or offset % block_size != 0:
+            return
+        if offset + len(data) != size and len(data) != block_size:
+            return
+
+        # Blocks arrive in any order, the partial is sized up front and remembers the offsets it received
+        blocks = self.partials.get(name)
+        if blocks is None:
+            blocks = self.partials[name] = set()
+            with open(self.file_path(name, partial=True), "wb") as file:
+                file.truncate(size)
+            if len(self.partials) > self.max_partials:
+                dropped, dropped_blocks = self.partials.popitem(last=False)
+                os.remove(self.file_path(dropped, partial=True))
+        else:
+            self.partials.move_to_end(name)
+        if offset in blocks:
+            return
+
+        with open(self.file_path(name, partial=True), "r+b") as file:
+            file.seek(offset)
+            file.write(data)
+        blocks.add(offset)
+
+        if len(blocks) == (size + block_size - 1) // block_size:
+            del self.partials[name]
+            self.commit(name, size)
@@ -0,0 +1,103 @@
+from yaml import safe_load
+import tempfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Formats that are already compressed, sampling them would only waste time
+INCOMPRESSIBLE_TYPES = ("image/", "video/", "audio/", "application/zip", "application/gzip", "application/x-7z-compressed", "application/x-rar", "application/zstd", "application/pdf")
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/xml", "application/javascript", "application/x-ndjson", "application/sql", "application/csv")
+
+
+def compressobj(codec):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return zlib.compressobj(6, zlib.DEFLATED, 31)  # gzip container
+
+
+def decompressobj(codec):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj(31)
+
+
+async def decompress(body, codec):
+    decompressor = decompressobj(codec)
+    async for data in body:
+        data = decompressor.decompress(data)
+        if data:
+            yield data
+    if codec != "zstd":
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+async def slice_stream(body, start=0, stop=None):
+    # Compressed files can not seek, ranges are cut out of the decompressed stream
+    position = 0
+    async for data in body:
+        end = position + len(data)
+        if end > start:
+            yield data[max(start - position, 0):len(data) if stop is None else max(stop - position, 0)]
+        position = end
+        if stop is not None and position >= stop:
+            break
+
+
+class Compressor:
+    def __init__(self):
+        with open("config.yaml", "r") as config_file:
+            config = safe_load(config_file)
+
+        self.codec = config.get("compression")
+        if self.codec == "zstd" and zstandard is None:
+            print("zstandard is not installed, falling back to gzip compression")
+            self.codec = "gzip"
+
+        self.sample_size = config.get("compression_sample_size", 256 * 1024)
+        self.min_ratio = config.get("compression_min_ratio", 0.9)
+        self.block_size = 1024 * 1024
+
+    def choose(self, stream, type_):
+        if not self.codec:
+            return None
+
+        type_ = (type_ or "").lower()
+        if type_.startswith(INCOMPRESSIBLE_TYPES):
+            return None
+        if type_.startswith(COMPRESSIBLE_TYPES):
+            return self.codec
+
+        # Unknown types are compressed when a sample from their start shrinks enough, with the cheapest zlib level
+        sample = stream.read(self.sample_size)
+        stream.seek(0)
+        if not sample:
+            return None
+        return self.codec if len(zlib.compress(sample, 1)) <= len(sample) * self.min_ratio else None
+
+    def compress(self, stream, codec):
+        # Returns the compressed copy of the stream and the original size, None when compression did not help
+        compressor = compressobj(codec)
+        output = tempfile.TemporaryFile(dir="temp")
+        size = 0
+
+        stream.seek(0)
+        while True:
+            data = stream.read(self.block_size)
+            if not data:
+                break
+            size += len(data)
+            output.write(compressor.compress(data))
+        output.write(compressor.flush())
+        stream.seek(0)
+
+        if output.tell() >= size:
+            output.close()
+            return None, size
+        output.seek(0)
+        return output, size
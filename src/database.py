@@ -4,12 +4,12 @@ from yaml import safe_load
 
 class Database:
 
-    def __init__(self):
+    def __init__(self, event_listeners=None):
         with open("config.yaml", "r") as config_file:
             config = safe_load(config_file)
 
         mongo_uri = config["mongo_uri"]
-        mongo_client = AsyncIOMotorClient(mongo_uri)
+        mongo_client = AsyncIOMotorClient(mongo_uri, event_listeners=event_listeners or [])
 
         db_name = config["db_name"]
         self.db = mongo_client[db_name]
@@ -0,0 +1,47 @@
+class DirectoryTree:
+    def __init__(self):
+        # Directory id -> (name, parent id), ids are kept as strings like in the API
+        self.directories = {}
+
+    async def load(self, db):
+        directories = {}
+        async for directory in db.directories.find({}, {"name": 1, "parent": 1}):
+            parent = directory.get("parent")
+            directories[str(directory["_id"])] = (directory["name"], str(parent) if parent else None)
+        self.directories = directories
+
+    def set(self, directory_id, name, parent):
+        self.directories[str(directory_id)] = (name, str(parent) if parent else None)
+
+    def set_parent(self, directory_id, parent):
+        directory = self.directories.get(str(directory_id))
+        if directory is not None:
+            self.set(directory_id, directory[0], parent)
+
+    def remove(self, directories_ids):
+        for directory_id in directories_ids:
+            self.directories.pop(str(directory_id), None)
+
+    def paths(self, directories_ids=None):
+        # Paths end with a slash and are relative to the root ("" for the root itself), ancestors are resolved once
+        paths = {None: ""}
+        for directory_id in self.directories if directories_ids is None else directories_ids:
+            directory_id = str(directory_id) if directory_id else None
+            chain = []
+            while directory_id not in paths:
+                directory = self.directories.get(directory_id)
+                if directory is None or directory_id in chain:
+                    paths[directory_id] = ""
+                    break
+                chain.append(directory_id)
+                directory_id = directory[1]
+
+            path = paths[directory_id]
+            for chain_id in reversed(chain):
+                path = f"{path}{self.directories[chain_id][0]}/"
+                paths[chain_id] = path
+
+        return paths
+
+    def path(self, directory_id):
+        return self.paths([directory_id])[str(directory_id) if directory_id else None]
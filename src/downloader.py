@@ -0,0 +1,144 @@
+import asyncio
+import collections
+import time
+
+from src.telegram import Slice
+from src.scheduler import INTERACTIVE
+import src.metrics as metrics
+
+
+class Downloader:
+    def __init__(self, telegram, cache, window, block_size):
+        self.telegram = telegram
+        self.cache = cache
+        self.window = window
+        self.block_size = block_size
+
+        self.blocks = 0
+        self.wait_time = 0
+
+    def stats(self):
+        return {
+            "window": self.window,
+            "block_size": self.block_size,
+            "blocks": self.blocks,
+            "wait_time": self.wait_time,
+            "average_wait_time": self.wait_time / self.blocks if self.blocks else 0,
+        }
+
+    def segments(self, chunks, start=0, stop=None):
+        # Maps a byte range of the file onto (chunk, offset, length) blocks, chunks are (session, message, cache key)
+        offset = 0
+        for chunk in chunks:
+            session, message, key = chunk
+            chunk_size = message.file.size
+            chunk_stop = min(stop - offset, chunk_size) if stop is not None else chunk_size
+            position = max(start - offset, 0)
+
+            while position < chunk_stop:
+                length = min(self.block_size - position % self.block_size, chunk_stop - position)
+                yield chunk, position, length
+                position += length
+
+            offset += chunk_size
+            if stop is not None and offset >= stop:
+                break
+
+    async def fetch(self, chunk, offset, length):
+        if chunk is None:
+            return b""
+
+        session, message, key = chunk
+        cached = self.cache.get(key, offset, length)
+        if cached is not None:
+            return cached
+
+        # Telegram only accepts parts that divide 1 MB and start at a multiple of their size,
+        # so the request starts at the aligned offset below and the leading bytes are dropped
+        request_size = 4096
+        while request_size * 2 <= min(self.block_size, 512 * 1024):
+            request_size *= 2
+        start = offset + message.offset if isinstance(message, Slice) else offset
+        skip = start % request_size
+
+        async def download(client):
+            data = bytearray()
+            async with client.iter_download(message.media, offset=start - skip, request_size=request_size) as parts:
+                async for part in parts:
+                    data += part
+                    if len(data) >= skip + length:
+                        break
+            return bytes(data[skip:skip + length])
+
+        started = time.monotonic()
+        data = await self.telegram.call(session, "download", INTERACTIVE, download)
+        metrics.inc("telegram_bytes_total", len(data), direction="download")
+        metrics.inc("telegram_transfer_seconds_total", time.monotonic() - started, direction="download")
+        metrics.inc("telegram_chunks_total", direction="download")
+        self.cache.put_block(key, message.file.size, offset, data, self.block_size)
+        return data
+
+    async def stream(self, segments):
+        # Keeps up to `window` blocks in flight ahead of the consumer and hands them out in order
+        tasks = collections.deque()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(tasks) < self.window:
+                    segment = await anext(segments, None)
+                    if segment is None:
+                        exhausted = True
+                    else:
+                        key, chunk, offset, length = segment
+                        tasks.append((key, asyncio.ensure_future(self.fetch(chunk, offset, length))))
+
+                if not tasks:
+                    break
+
+                key, task = tasks.popleft()
+                start = time.monotonic()
+                data = await task
+                self.wait_time += time.monotonic() - start
+                self.blocks += 1
+                yield key, data
+        finally:
+            for key, task in tasks:
+                task.cancel()
+
+    async def read(self, chunks, start=0, stop=None):
+        async def segments():
+            for chunk, offset, length in self.segments(chunks, start, stop):
+                yield None, chunk, offset, length
+
+        with metrics.active("transfers_active", direction="download"):
+            async for key, data in self.stream(segments()):
+                yield data
+
+    async def read_files(self, files):
+        # Prefetching runs across file boundaries, each file still gets its own ordered body
+        items = []
+
+        async def segments():
+            async for item, chunks in files:
+                items.append(item)
+                yield len(items) - 1, None, 0, 0
+                for chunk, offset, length in self.segments(chunks):
+                    yield len(items) - 1, chunk, offset, length
+
+        blocks = self.stream(segments())
+        with metrics.active("transfers_active", direction="download"):
+            block = await anext(blocks, None)
+            while block is not None:
+                index = block[0]
+
+                async def body():
+                    nonlocal block
+                    while block is not None and block[0] == index:
+                        if block[1]:
+                            yield block[1]
+                        block = await anext(blocks, None)
+
+                file_body = body()
+                yield items[index], file_body
+                async for data in file_body:
+                    pass
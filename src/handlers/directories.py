@@ -12,26 +12,53 @@ def get_directories_query(names, parents):
     return query
 
 
-async def get_directories(db, names=None, parents=None, recursive=None):
+async def get_directories(db, names=None, parents=None, recursive=None, limit=None, after=None, fields=None, stream=None):
+    page = utils.get_page(limit, after)
+    if page is None:
+        return "Invalid limit or after", 400
+
     query = get_directories_query(names, parents)
-    directories = await db.directories.find(query).to_list(None)
     if recursive:
-        for directory in directories:
-            children, code = await get_directories(db, parents=[directory["_id"]], recursive=True)
-            directories.extend([child for child in children if child not in directories])
+        directories = await get_subtrees(db, query)
+    else:
+        cursor = utils.find_page(db.directories, query, *page, fields=fields)
+        if stream:
+            return utils.send_ndjson(cursor), 200
+        directories = await cursor.to_list(None)
+
+    return directories, 200
+
+
+async def get_subtrees(db, query):
+    # Matching directories and all their descendants in one $graphLookup, shallowest first
+    results = db.directories.aggregate([
+        {"$match": query},
+        {"$graphLookup": {"from": "directories", "startWith": "$_id", "connectFromField": "_id", "connectToField": "parent", "as": "descendant", "depthField": "depth"}},
+        {"$unwind": {"path": "$descendant", "preserveNullAndEmptyArrays": True}},
+    ])
 
-    return utils.make_json_serializable(directories), 200
+    directories = {}
+    descendants = []
+    async for result in results:
+        descendant = result.pop("descendant", None)
+        directories[result["_id"]] = result
+        if descendant is not None:
+            descendants.append(descendant)
+
+    for descendant in sorted(descendants, key=lambda descendant: descendant.pop("depth")):
+        directories.setdefault(descendant["_id"], descendant)
+    return list(directories.values())
 
 
 async def get_directory(db, directory_id):
     directory = await db.directories.find_one({"_id": bson.ObjectId(directory_id)})
     if directory:
-        return utils.make_json_serializable(directory), 200
+        return directory, 200
     else:
         return "Directory not found", 404
 
 
-async def create_directory(db, name, parent):
+async def create_directory(db, name, parent, tree):
     if parent == "/":
         parent = None
     directory = await db.directories.find_one({"name": name, "parent": bson.ObjectId(parent)})
@@ -45,45 +72,46 @@ async def create_directory(db, name, parent):
                 return "Invalid parent id", 400
         directory = {"name": name, "parent": parent}
         await db.directories.insert_one(directory)
-        return utils.make_json_serializable(directory["_id"]), 200
-
+        tree.set(directory["_id"], name, parent)
+        return str(directory["_id"]), 200
 
-async def delete_directory(directory_id, db, telegram):
-    directory = await db.directories.find_one({"_id": bson.ObjectId(directory_id)})
-    if directory:
-        await db.directories.delete_one({"_id": bson.ObjectId(directory_id)})
 
-        directories, code = await get_directories(db, parents=[directory_id], recursive=True)
-        directories_ids = [directory["_id"] for directory in directories]
-
-        await delete_directories(directories_ids, db, telegram)
-
-        directory_files, code = await handlers_files.get_files(db, directories=[directory_id] + directories_ids)
-        await handlers_files.delete_files([file["_id"] for file in directory_files], db, telegram)
-        return utils.make_json_serializable(directory["_id"]), 200
+async def delete_directory(directory_id, db, telegram, tree):
+    directories, code = await delete_directories([directory_id], db, telegram, tree)
+    if directories:
+        return directories[0], 200
     else:
         return "Directory not found", 404
 
 
-async def delete_directories(directories_ids, db, telegram):
-    responses = []
-    for _id in directories_ids:
-        res = await delete_directory(_id, db, telegram)
-        responses.append(res)
+async def delete_directories(directories_ids, db, telegram, tree):
+    # The whole forest is resolved once, files go first so a failure never leaves files in a missing directory
+    directories = await get_subtrees(db, {"_id": {"$in": [bson.ObjectId(directory_id) for directory_id in directories_ids]}})
+    if not directories:
+        return [], 200
 
-    return [response[0] for response in responses], 200
+    ids = [directory["_id"] for directory in directories]
+    files = await db["files"].find({"directory": {"$in": ids}}, {"_id": 1}).to_list(None)
+    if files:
+        await handlers_files.delete_files([file["_id"] for file in files], db, telegram)
+
+    await db.directories.delete_many({"_id": {"$in": ids}})
+    tree.remove(ids)
+
+    deleted = {str(directory_id) for directory_id in ids}
+    return [str(directory_id) for directory_id in directories_ids if str(directory_id) in deleted], 200
 
 
-async def patch_directories(directories_ids, db, telegram, new_name=None, new_parent=None):
+async def patch_directories(directories_ids, db, telegram, tree, new_name=None, new_parent=None):
     responses = []
     for _id in directories_ids:
-        res = await patch_directory(_id, db, telegram, new_name, new_parent)
+        res = await patch_directory(_id, db, telegram, tree, new_name, new_parent)
         responses.append(res)
 
     return [response[0] for response in responses], 200
 
 
-async def patch_directory(directory_id, db, telegram, new_name=None, new_parent=None):
+async def patch_directory(directory_id, db, telegram, tree, new_name=None, new_parent=None):
     directory = await db.directories.find_one({"_id": bson.ObjectId(directory_id)})
     if directory:
         if new_name:
@@ -91,9 +119,10 @@ async def patch_directory(directory_id, db, telegram, new_name=None, new_parent=
         if new_parent:
             directory["parent"] = bson.ObjectId(new_parent)
         await db.directories.update_one({"_id": bson.ObjectId(directory_id)}, {"$set": directory})
+        tree.set(directory_id, directory["name"], directory["parent"])
 
-        await merge_similar_directories(db, telegram, directory_id)
-        return utils.make_json_serializable(directory["_id"]), 200
+        await merge_similar_directories(db, telegram, tree, directory_id)
+        return str(directory["_id"]), 200
     else:
         return "Directory not found", 404
 
@@ -102,42 +131,44 @@ async def get_directory_children(directory_id, db, recursive=None):
     directory = await db.directories.find_one({"_id": bson.ObjectId(directory_id)})
     if directory:
         children, code = await get_directories(db, parents=[directory_id], recursive=recursive)
-        return utils.make_json_serializable([child["_id"] for child in children]), 200
+        return [child["_id"] for child in children], 200
     else:
         return "Directory not found", 404
 
 
-async def add_directory_children(directory_id, db, children_ids):
+async def add_directory_children(directory_id, db, children_ids, tree):
     directory = await db.directories.find_one({"_id": bson.ObjectId(directory_id)})
     if directory:
         for child_id in children_ids:
             await db.directories.update_one({"_id": bson.ObjectId(child_id)}, {"$set": {"parent": bson.ObjectId(directory_id)}})
-        return utils.make_json_serializable(directory["_id"]), 200
+            tree.set_parent(child_id, directory_id)
+        return str(directory["_id"]), 200
     else:
         return "Directory not found", 404
 
 
-async def remove_directory_children(directory_id, db, children_ids, recursive=None):
+async def remove_directory_children(directory_id, db, children_ids, tree, recursive=None):
     directory = await db.directories.find_one({"_id": bson.ObjectId(directory_id)})
     if directory:
-        directories = await get_directories(db, parents=[directory_id], recursive=recursive)
+        directories, code = await get_directories(db, parents=[directory_id], recursive=recursive)
+        directories_ids = {str(directory["_id"]) for directory in directories}
         for child_id in children_ids:
-            if child_id in [directory["_id"] for directory in directories]:
+            if child_id in directories_ids:
                 await db.directories.update_one({"_id": bson.ObjectId(child_id)}, {"$set": {"parent": None}})
-        return utils.make_json_serializable(directory["_id"]), 200
+                tree.set_parent(child_id, None)
+        return str(directory["_id"]), 200
     else:
         return "Directory not found", 404
 
 
-async def merge_similar_directories(db, telegram, directory_id):
+async def merge_similar_directories(db, telegram, tree, directory_id):
     directory_data, code = await get_directory(db, directory_id)
     if code == 200:
         directory = directory_data
         parents = [directory["parent"]] if directory["parent"] else []
         similar_directories, code = await get_directories(db, names=[directory["name"]], parents=parents)
         if len(similar_directories) > 1:
-            files, code = await handlers_files.get_files(db, directories=[directory_["_id"] for directory_ in similar_directories])
-            files_ids = [file["_id"] for file in files]
-            await handlers_files.patch_files(files_ids, db, telegram, new_directory=directory["_id"])
-            await delete_directories([similar_directory["_id"] for similar_directory in similar_directories[1:]], db, telegram)
-        return utils.make_json_serializable(directory["_id"]), 200
\ No newline at end of file
+            query = handlers_files.get_files_query(None, None, [directory_["_id"] for directory_ in similar_directories])
+            await handlers_files.patch_files(query, db, telegram, new_directory=directory["_id"])
+            await delete_directories([similar_directory["_id"] for similar_directory in similar_directories[1:]], db, telegram, tree)
+        return str(directory["_id"]), 200
\ No newline at end of file
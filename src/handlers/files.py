@@ -1,55 +1,72 @@
 import bson
-from quart import send_file
-import os
+import pymongo
+from quart import Response
 from tqdm.auto import tqdm
+from werkzeug.datastructures import ContentRange
 import datetime as dt
-import io
 import asyncio
+import collections
+import secrets
 
 import src.utils as utils
 import src.validators as validators
 import src.zipper as zipper
-
-global pbar
-global prev_curr
+import src.reaper as reaper
+import src.compression as compression
+import src.packs as packs
+import src.metrics as metrics
 
 
 def get_files_query(tags, file_types, directories):
     query = {}
 
     if tags:
-        query["tags"] = {"$all": tags}
+        # A list stands for a tag and its descendants, any of them matches
+        if any(isinstance(tag, list) for tag in tags):
+            query["$and"] = [{"tags": {"$in": tag}} if isinstance(tag, list) else {"tags": tag} for tag in tags]
+        else:
+            query["tags"] = {"$all": tags}
 
     if file_types:
         query["type"] = {"$in": file_types}
 
     if directories:
-        query["$or"] = [{"directory": bson.ObjectId(directory) if directory != "/" else None} for directory in directories]
+        query["directory"] = {"$in": [bson.ObjectId(directory) if directory != "/" else None for directory in directories]}
 
     return query
 
 
-async def progress(current, total, index=None, max_file_size=None):
-    global pbar
-    global prev_curr
+def chunks_progress(pbar, chunks, on_progress=None):
+    sent = [0] * len(chunks)
+
+    # Chunks upload concurrently, each one reports its own position and only the delta goes to the file's bar
+    def callback(index):
+        def update(current, total):
+            pbar.update(current - sent[index])
+            sent[index] = current
+            if on_progress is not None:
+                on_progress(pbar.n)
+        return update
 
-    progress = current - prev_curr
-    progress += index * max_file_size if (index is not None and max_file_size is not None) else progress
-    pbar.update(progress)
+    return callback
 
-    prev_curr = current
-    prev_curr += index * max_file_size if (index is not None and max_file_size is not None) else prev_curr
 
+async def get_files(db, tags=None, file_types=None, directories=None, limit=None, after=None, fields=None, stream=None):
+    page = utils.get_page(limit, after)
+    if page is None:
+        return "Invalid limit or after", 400
 
-async def get_files(db, tags=None, file_types=None, directories=None):
     query = get_files_query(tags, file_types, directories)
-    files = await db["files"].find(query).to_list(None)
-    return utils.make_json_serializable(files), 200
+    cursor = utils.find_page(db["files"], query, *page, fields=fields)
+    if stream:
+        return utils.send_ndjson(cursor), 200
+
+    files = await cursor.to_list(None)
+    return files, 200
 
 
 async def get_file(file_id, db):
     file = await db["files"].find_one({"_id": bson.ObjectId(file_id)})
-    file = utils.make_json_serializable(file)
 
     if file is None:
         return "File not found", 404
@@ -57,38 +74,42 @@ async def get_file(file_id, db):
 
 
 async def delete_files(file_ids, db, telegram):
-    print(file_ids)
-    responses = []
+    # Files are gone as soon as Mongo says so, their messages are queued for the reaper
+    ids = [bson.ObjectId(file_id) for file_id in file_ids]
+    files = await db["files"].find({"_id": {"$in": ids}}).to_list(None)
+    if not files:
+        return [], 404
 
-    for file_id in file_ids:
-        response = await delete_file(file_id, db, telegram)
-        responses.append(response)
-
-    ids = [response[0] for response in responses if response[1] == 200]
-    return ids, 200 if len(ids) > 0 else 404
+    await db["files"].delete_many({"_id": {"$in": [file["_id"] for file in files]}})
+    await release_chunks(db, telegram, [chunk for file in files for chunk in file["chunks"]])
+    return files, 200
 
 
 async def delete_file(file_id, db, telegram):
-    file_data = await db["files"].find_one({"_id": bson.ObjectId(file_id)})
-    if file_data is None:
+    files, code = await delete_files([file_id], db, telegram)
+    if code != 200:
         return "File not found", 404
-
-    chunks_ids = file_data["chunks"]
-    await telegram.client.delete_messages(telegram.chanel_name, chunks_ids)
-
-    delete_result = await db["files"].delete_one({"_id": bson.ObjectId(file_id)})
-    return utils.make_json_serializable(file_data), 200
+    return files[0], 200
 
 
-async def patch_files(file_ids, db, telegram, new_directory=None, new_tags=None):
-    responses = []
+async def patch_files(query, db, telegram, new_directory=None, new_tags=None):
+    update = {}
+    if new_tags:
+        update["tags"] = new_tags
+    if new_directory:
+        try:
+            update["directory"] = bson.ObjectId(new_directory)
+        except bson.errors.InvalidId:
+            return "Invalid directory id", 400
 
-    for file_id in file_ids:
-        response = await patch_file(file_id, db, telegram, new_directory, new_tags)
-        responses.append(response)
+    if not update:
+        matched = await db["files"].count_documents(query)
+        return {"matched": matched, "modified": 0, "merged": 0}, 200 if matched > 0 else 404
 
-    ids = [response[0] for response in responses if response[1] == 200]
-    return ids, 200 if len(ids) > 0 else 404
+    result, code = await update_files(query, db, {"$set": update})
+    if "directory" in update and result["modified"]:
+        result["merged"] = await merge_similar_files_in(db, telegram, update["directory"])
+    return result, code
 
 
 async def patch_file(file_id, db, telegram, new_directory=None, new_tags=None, new_name=None):
@@ -109,7 +130,7 @@ async def patch_file(file_id, db, telegram, new_directory=None, new_tags=None, n
     await db["files"].update_one({"_id": bson.ObjectId(file_id)}, {"$set": file_data})
     await merge_similar_files(db, telegram, file_data["_id"])
 
-    return utils.make_json_serializable(file_data["_id"]), 200
+    return str(file_data["_id"]), 200
 
 
 async def post_files_tags(file_ids, db, tags, telegram):
@@ -132,8 +153,7 @@ async def post_file_tags(file_id, db, tags, telegram):
     await db["files"].update_one({"_id": bson.ObjectId(file_id)}, {"$set": file_data})
     await merge_similar_files(db, telegram, file_data["_id"])
 
-    file_data = utils.make_json_serializable(file_data)
-    return file_data["_id"], 200
+    return str(file_data["_id"]), 200
 
 
 async def delete_files_tags(file_ids, db, tags, telegram):
@@ -156,19 +176,11 @@ async def delete_file_tags(file_id, db, tags, telegram):
     await db["files"].update_one({"_id": bson.ObjectId(file_id)}, {"$set": file_data})
     await merge_similar_files(db, telegram, file_data["_id"])
 
-    file_data = utils.make_json_serializable(file_data)
-    return file_data["_id"], 200
+    return str(file_data["_id"]), 200
 
 
-async def add_tags_to_files(file_ids, db, tags, telegram):
-    responses = []
-
-    for file_id in file_ids:
-        response = await add_tags_to_file(file_id, db, tags, telegram)
-        responses.append(response)
-
-    ids = [response[0] for response in responses if response[1] == 200]
-    return ids, 200 if len(ids) > 0 else 404
+async def add_tags_to_files(query, db, tags, telegram):
+    return await update_files(query, db, {"$addToSet": {"tags": {"$each": tags}}})
 
 
 async def add_tags_to_file(file_id, db, tags, telegram):
@@ -179,19 +191,11 @@ async def add_tags_to_file(file_id, db, tags, telegram):
     file_data["tags"] = list(set(file_data["tags"] + tags))
     await db["files"].update_one({"_id": bson.ObjectId(file_id)}, {"$set": file_data})
     await merge_similar_files(db, telegram, file_data["_id"])
-    file_data = utils.make_json_serializable(file_data)
-    return file_data["_id"], 200
-
-
-async def remove_tags_from_files(file_ids, db, tags, telegram):
-    responses = []
+    return str(file_data["_id"]), 200
 
-    for file_id in file_ids:
-        response = await remove_tags_from_file(file_id, db, tags, telegram)
-        responses.append(response)
 
-    ids = [response[0] for response in responses if response[1] == 200]
-    return ids, 200 if len(ids) > 0 else 404
+async def remove_tags_from_files(query, db, tags, telegram):
+    return await update_files(query, db, {"$pull": {"tags": {"$in": tags}}})
 
 
 async def remove_tags_from_file(file_id, db, tags, telegram):
@@ -202,19 +206,11 @@ async def remove_tags_from_file(file_id, db, tags, telegram):
     file_data["tags"] = [tag for tag in file_data["tags"] if tag not in tags]
     await db["files"].update_one({"_id": bson.ObjectId(file_id)}, {"$set": file_data})
     await merge_similar_files(db, telegram, file_data["_id"])
-    file_data = utils.make_json_serializable(file_data)
-    return file_data["_id"], 200
-
-
-async def delete_all_tags_from_files(file_ids, db, telegram):
-    responses = []
+    return str(file_data["_id"]), 200
 
-    for file_id in file_ids:
-        response = await delete_all_tags_from_file(file_id, db, telegram)
-        responses.append(response)
 
-    ids = [response[0] for response in responses if response[1] == 200]
-    return ids, 200 if len(ids) > 0 else 404
+async def delete_all_tags_from_files(query, db, telegram):
+    return await update_files(query, db, {"$set": {"tags": []}})
 
 
 async def delete_all_tags_from_file(file_id, db, telegram):
@@ -228,15 +224,11 @@ async def delete_all_tags_from_file(file_id, db, telegram):
     return file_id, 200
 
 
-async def delete_files_directory(file_ids, db, telegram):
-    responses = []
-
-    for file_id in file_ids:
-        response = await delete_file_directory(file_id, db, telegram)
-        responses.append(response)
-
-    ids = [response[0] for response in responses if response[1] == 200]
-    return ids, 200 if len(ids) > 0 else 404
+async def delete_files_directory(query, db, telegram):
+    result, code = await update_files(query, db, {"$set": {"directory": None}})
+    if result["modified"]:
+        result["merged"] = await merge_similar_files_in(db, telegram, None)
+    return result, code
 
 
 async def delete_file_directory(file_id, db, telegram):
@@ -250,28 +242,78 @@ async def delete_file_directory(file_id, db, telegram):
     return file_id, 200
 
 
-async def upload_files(files, files_data, db, telegram, chunker):
-    responses = []
+async def update_files(query, db, update):
+    # One set-oriented update for the whole filter. Tags are not part of what makes files similar,
+    # so only a directory change can create duplicates and those callers merge once for the batch
+    result = await db["files"].update_many(query, update)
+    return {"matched": result.matched_count, "modified": result.modified_count, "merged": 0}, 200 if result.matched_count > 0 else 404
+
+
+async def upload_files(files, files_data, db, telegram, chunker, cache, compressor, packer, transfers, transfer_id=None):
+    # Input is checked before the transfer exists, a rejected request never leaves it running
+    try:
+        files_data = [utils.load_json_from_string(file_data) for file_data in files_data]
+    except ValueError:
+        return "Invalid file data", 400
+    if not all(isinstance(file_data, dict) for file_data in files_data):
+        return "Invalid file data", 400
+
+    # Files of the batch are checked concurrently, so copies of the same file inside it never see each other in Mongo
+    seen = set()
+    duplicates = set()
+    for index, (file, file_data) in enumerate(zip(files, files_data)):
+        key = get_file_key(file.filename, file_data)
+        if key in seen:
+            duplicates.add(index)
+        seen.add(key)
+
+    sizes = [utils.get_stream_size(file.stream) for file in files]
+    try:
+        transfer = transfers.create("upload", f"{len(files)} files", sum(sizes), transfer_id)
+    except ValueError as e:
+        return str(e), 409
 
     bar = tqdm(total=len(files), unit="files", desc="Uploading files")
-    for file, file_data in zip(files, files_data):
-        file_data = utils.load_json_from_string(file_data)
-        response = await upload_file(file, file_data, db, telegram, chunker)
-        responses.append(response)
+
+    async def upload(file, file_data, size, duplicate):
+        if duplicate:
+            bar.update(1)
+            return "File already exists", 400
+
+        reported = 0
+
+        # Each file reports its own position, only the delta goes to the shared transfer
+        def on_progress(done):
+            nonlocal reported
+            transfer.add(done - reported)
+            reported = done
+
+        response = await upload_file(file, file_data, db, telegram, chunker, cache, compressor, packer, on_progress)
+        if response[1] == 200:
+            # Compressed files report their stored bytes, the transfer counts original ones
+            on_progress(size)
         bar.update(1)
-    bar.close()
+        return response
 
-    ids = [response[0] for response in responses if response[1] == 200]
-    return ids, 200 if len(ids) > 0 else 404
+    # Files go through the same bounded upload window as their chunks
+    ids = []
+    try:
+        responses = await asyncio.gather(*[upload(file, file_data, size, index in duplicates) for index, (file, file_data, size) in enumerate(zip(files, files_data, sizes))])
+        ids = [response[0] for response in responses if response[1] == 200]
+    finally:
+        bar.close()
+        transfers.finish(transfer, "done" if len(ids) == len(files) else "failed")
+    return ids, 200 if len(ids) > 0 else 404, {"X-Transfer-Id": transfer.id}
 
 
-async def upload_file(file, file_data, db, telegram, chunker):
-    global pbar
-    global prev_curr
-    global total_progress
+def get_file_key(name, file_data):
+    # Fields of the duplicate check in get_file_document
+    directory = file_data.get("directory")
+    return name, file_data.get("type"), file_data.get("size"), None if directory in (None, "/") else str(directory)
 
-    name = file.filename
 
+async def get_file_document(name, file_data, db):
+    # The files document of an upload, without its chunks
     if not validators.validate_file_upload(file_data):
         return f"Invalid file data for file {name}", 400
 
@@ -293,127 +335,283 @@ async def upload_file(file, file_data, db, telegram, chunker):
     if file_exists:
         return "File already exists", 400
 
-    chunks = chunker.split(file) if size > telegram.max_file_size else [file]
-    chunks_ids = []
-
-    chunks_pbar = tqdm(total=len(chunks), unit="chunk", desc="Uploading chunks")
-    prev_curr = 0
-    pbar = tqdm(total=file_data["size"], unit="B", unit_scale=True, desc=name, initial=prev_curr)
-    for index, chunk in enumerate(chunks):
-
-        if len(chunks) == 1:
-            if '/' in type_:
-                extension = type_.split('/')[1]
-                with open(f'temp.{extension}', 'wb') as f:
-                    f.write(chunk.read())
-                chunk = 'temp.' + extension
-
-        message = await telegram.client.send_file(telegram.chanel_name, chunk, caption=f"{name} - {index + 1}/{len(chunks)}", progress_callback=lambda current, total: progress(current, total, index, telegram.max_file_size))
-        chunks_ids.append(message.id)
-
-        chunks_pbar.update(1)
-
-    chunks_pbar.close()
-    pbar.close()
-
-    file_data = {
+    return {
         "name": name,
         "size": size,
         "type": type_,
         "tags": tags,
-        "directory": bson.ObjectId(directory) if directory else None,
+        "directory": directory,
         "created_at": created_at,
         "uploaded_at": uploaded_at,
-        "chunks": chunks_ids,
-    }
-
-    res = await db["files"].insert_one(file_data)
-    return utils.make_json_serializable(res.inserted_id), 200
-
-
-async def download_files(file_ids, db, telegram, chunker):
-    files = []
-    bar = tqdm(total=len(file_ids), unit="files", desc="Downloading files")
-    for file_id in file_ids:
-        file = await download_file(file_id, db, telegram, chunker)
-        files.append(file)
-        bar.update(1)
-    bar.close()
-
-    files = [file[0] for file in files if file is not None]
-
-    file_names = [file[0] for file in files if file is not None]
-    file_names = utils.rename_duplicates(file_names)
-
-    files_bytes = [file[1] for file in files if file is not None]
-
+    }, 200
 
-    files = []
-    for file_name, file_bytes in zip(file_names, files_bytes):
-        files.append((file_name, file_bytes))
 
-    return await send_files(files)
-
-
-async def download_file(file_id, db, telegram, chunker):
-    global pbar
-    global prev_curr
+async def upload_file(file, file_data, db, telegram, chunker, cache, compressor, packer, on_progress=None):
+    name = file.filename
 
+    file_document, code = await get_file_document(name, file_data, db)
+    if code != 200:
+        return file_document, code
+
+    # Compressible files are compressed into a temporary copy before chunking, downloads decompress them on the fly
+    loop = asyncio.get_running_loop()
+    stream = file.stream
+    codec = await loop.run_in_executor(None, compressor.choose, stream, file_document["type"])
+    if codec:
+        compressed, size = await loop.run_in_executor(None, compressor.compress, stream, codec)
+        if compressed is None:
+            codec = None
+        else:
+            stream = compressed
+            file_document["size"] = file_document["size"] if file_document["size"] is not None else size
+
+    # Chunks are views over the spooled upload, Telethon reads them part by part so no chunk is ever held in memory.
+    # Content-defined splitting hashes the whole file, so it runs off the event loop
+    chunks = await loop.run_in_executor(None, chunker.split, stream, name)
+
+    pbar = tqdm(total=sum(chunk.length for chunk in chunks), unit="B", unit_scale=True, desc=name)
+    progress = chunks_progress(pbar, chunks, on_progress)
+
+    async def send_chunk(index, chunk):
+        if chunk.hash:
+            record = await reference_chunk(db, chunk.hash)
+            if record is not None:
+                progress(index)(chunk.length, chunk.length)
+                return record
+
+        # Small files share pack messages instead of costing a message and an API call each
+        if packer.packable(chunks):
+            record = await packer.add(chunk)
+            progress(index)(chunk.length, chunk.length)
+            return record
+
+        async with telegram.upload_window:
+            record = await telegram.send_chunk(chunk, caption=f"{name} - {index + 1}/{len(chunks)}", force_document=True, file_size=chunk.length, progress_callback=progress(index))
+        await cache.put_stream(telegram.key(record), chunk, chunk.length)
+
+        if chunk.hash:
+            record = await register_chunk(db, telegram, chunk.hash, record, chunk.length)
+        return record
+
+    with metrics.active("transfers_active", direction="upload"):
+        tasks = [asyncio.ensure_future(send_chunk(index, chunk)) for index, chunk in enumerate(chunks)]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION) if tasks else (set(), set())
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    pbar.close()
+    if stream is not file.stream:
+        stream.close()
+
+    # A failed chunk fails the whole file, already sent chunks are removed so no partial record is left behind
+    if any(task.exception() is not None for task in done) or pending:
+        await release_chunks(db, telegram, [task.result() for task in done if task.exception() is None])
+        return f"Failed to upload file {name}", 500
+
+    chunks_records = [task.result() for task in tasks]
+    if codec:
+        file_document.update({"codec": codec, "stored_size": sum(chunk.length for chunk in chunks)})
+
+    res = await db["files"].insert_one({**file_document, "chunks": chunks_records})
+    return str(res.inserted_id), 200
+
+
+async def download_files(file_ids, db, telegram, downloader, tree, transfers):
+    files = await db["files"].find({"_id": {"$in": [bson.ObjectId(file_id) for file_id in file_ids]}}).to_list(None)
+    if not files:
+        return "No files found", 404
+
+    # Archive paths keep the directory hierarchy, only real collisions get renamed
+    paths = tree.paths({file["directory"] for file in files})
+    names = utils.rename_duplicates([paths[str(file["directory"]) if file["directory"] else None] + file["name"] for file in files])
+
+    async def selected_files():
+        bar = tqdm(total=len(files), unit="files", desc="Downloading files")
+        # Files are resolved in batches of about one GetMessages request, instead of one request per file
+        batch = []
+        batch_chunks = 0
+        for index, (name, file_data) in enumerate(zip(names, files)):
+            batch.append((name, file_data))
+            batch_chunks += len(file_data["chunks"])
+            if batch_chunks < telegram.messages_batch_size and index < len(files) - 1:
+                continue
+
+            for (name, file_data), messages in zip(batch, await get_files_messages([file_data for name, file_data in batch], telegram)):
+                if messages is not None:
+                    yield (name, file_data.get("uploaded_at"), file_data.get("codec")), messages
+                bar.update(1)
+            batch = []
+            batch_chunks = 0
+        bar.close()
+
+    async def entries():
+        async for (name, date, codec), body in downloader.read_files(selected_files()):
+            yield name, date, compression.decompress(body, codec) if codec else body
+
+    # Sizes of the entries only, the archive headers are not counted
+    sizes = [file.get("size") for file in files]
+    transfer = transfers.new("download", "telecloud.zip", sum(sizes) if None not in sizes else None)
+
+    response = await send_stream(iter_progress(zipper.Zipper().zip(entries()), None, "telecloud.zip", transfers, transfer), "telecloud.zip", mimetype="application/zip")
+    response.headers["X-Transfer-Id"] = transfer.id
+    return response, 200
+
+
+async def stream_file(file_id, db, telegram, downloader, transfers, range_=None, if_range=None):
     file_data = await db["files"].find_one({"_id": bson.ObjectId(file_id)})
     if file_data is None:
         return "File not found", 404
 
-    chunks_ids = file_data["chunks"]
-    chunks = []
-    chunks_pbar = tqdm(total=len(chunks_ids), unit="chunk", desc="Downloading chunks")
-    for chunk_id in chunks_ids:
-        message = await telegram.client.get_messages(telegram.chanel_name, ids=chunk_id)
-
-        if not os.path.exists("temp"):
-            os.mkdir("temp")
-        file_path = f"temp/{chunk_id}" + message.file.ext if message.file.ext else f"temp/{chunk_id}"
-
-        prev_curr = 0
-        pbar = tqdm(total=message.file.size, unit="B", unit_scale=True, desc=file_data["name"])
-
-        await message.download_media(file_path, progress_callback=progress)
-        chunks.append(file_path)
-        chunks_pbar.update(1)
-
-    chunks_pbar.close()
-    pbar.close()
-
-    print(chunks, os.listdir("temp"))
-    bytes = chunker.join(chunks)
-
-    utils.clear_temp_folder()
-
-    file_name = file_data["name"]
-    return (file_name, bytes), 200
-
-
-async def send_files(files):
-    files_zipper = zipper.Zipper()
-    zip_file = files_zipper.zip(files, "temp/telecloud.zip")
-    return_data = io.BytesIO()
-    with open(zip_file, "rb") as f:
-        return_data.write(f.read())
-    return_data.seek(0)
-
-    utils.clear_temp_folder()
-
-    return await send_file(return_data, as_attachment=True, attachment_filename="telecloud.zip"), 200
-
-
-async def send_single_file(file):
-    file_name = file[0]
-    bytes = file[1]
-
-    return_data = io.BytesIO()
-    return_data.write(bytes)
-    return_data.seek(0)
-
-    return await send_file(return_data, as_attachment=True, attachment_filename=file_name), 200
+    # All chunk messages are resolved up front so a missing chunk fails before any byte is sent
+    messages = await get_chunks_messages(file_data, telegram)
+    if messages is None:
+        return "File chunks not found", 502
+
+    size = file_data["size"] if file_data.get("size") is not None else sum(message.file.size for session, message, key in messages)
+    codec = file_data.get("codec")
+
+    def read(start=0, stop=None):
+        if codec:
+            return compression.slice_stream(compression.decompress(downloader.read(messages), codec), start, stop)
+        return downloader.read(messages, start, stop)
+    name = file_data["name"]
+    mimetype = file_data.get("type") or "application/octet-stream"
+    etag = str(file_data["_id"])
+    last_modified = file_data.get("uploaded_at")
+
+    ranges = None
+    if range_ is not None and range_.units == "bytes" and utils.if_range_matches(if_range, etag, last_modified):
+        ranges = utils.get_satisfiable_ranges(range_, size)
+
+    transfer = transfers.new("download", name)
+
+    if ranges is None:
+        transfer.total = size
+        response = await send_stream(iter_progress(read(), size, name, transfers, transfer), name, size, mimetype)
+        code = 200
+
+    elif not ranges:
+        response = Response("Requested range not satisfiable")
+        response.content_range = ContentRange("bytes", None, None, size)
+        code = 416
+
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        transfer.total = stop - start
+        body = iter_progress(read(start, stop), stop - start, name, transfers, transfer)
+        response = await send_stream(body, name, stop - start, mimetype)
+        response.content_range = ContentRange("bytes", start, stop, size)
+        code = 206
+
+    else:
+        boundary = secrets.token_hex(16)
+        parts = [(f"\r\n--{boundary}\r\nContent-Type: {mimetype}\r\nContent-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n".encode(), start, stop) for start, stop in ranges]
+        end = f"\r\n--{boundary}--\r\n".encode()
+
+        async def body():
+            for header, start, stop in parts:
+                yield header
+                async for data in read(start, stop):
+                    yield data
+            yield end
+
+        length = sum(len(header) + stop - start for header, start, stop in parts) + len(end)
+        transfer.total = length
+        response = await send_stream(iter_progress(body(), length, name, transfers, transfer), name, length)
+        response.content_type = f"multipart/byteranges; boundary={boundary}"
+        code = 206
+
+    response.accept_ranges = "bytes"
+    if code != 416:
+        response.headers["X-Transfer-Id"] = transfer.id
+    response.set_etag(etag)
+    if isinstance(last_modified, dt.datetime):
+        response.last_modified = last_modified
+    return response, code
+
+
+async def reference_chunk(db, hash_):
+    chunk = await db["chunks"].find_one_and_update({"_id": hash_, "refs": {"$gt": 0}}, {"$inc": {"refs": 1}})
+    if chunk is None:
+        return None
+    return {**chunk["chunk"], "hash": hash_}
+
+
+async def register_chunk(db, telegram, hash_, record, size):
+    try:
+        await db["chunks"].insert_one({"_id": hash_, "chunk": record, "size": size, "refs": 1})
+    except pymongo.errors.DuplicateKeyError:
+        # The same content was uploaded concurrently, keep theirs and drop ours
+        existing = await reference_chunk(db, hash_)
+        if existing is None:
+            return record
+        await reaper.enqueue_chunks(db, telegram, [record])
+        return existing
+    return {**record, "hash": hash_}
+
+
+async def release_chunks(db, telegram, chunks):
+    # Deduplicated chunks are shared between files, their message is only deleted with the last reference
+    await packs.release_packed(db, telegram, [chunk for chunk in chunks if isinstance(chunk, dict) and "pack" in chunk])
+    chunks = [chunk for chunk in chunks if not isinstance(chunk, dict) or "pack" not in chunk]
+
+    orphans = [chunk for chunk in chunks if not isinstance(chunk, dict) or "hash" not in chunk]
+    hashes = collections.Counter(chunk["hash"] for chunk in chunks if isinstance(chunk, dict) and "hash" in chunk)
+
+    if hashes:
+        await db["chunks"].bulk_write([pymongo.UpdateOne({"_id": hash_}, {"$inc": {"refs": -count}}) for hash_, count in hashes.items()], ordered=False)
+        shared = {chunk["_id"]: chunk async for chunk in db["chunks"].find({"_id": {"$in": list(hashes)}})}
+
+        released = [hash_ for hash_, chunk in shared.items() if chunk["refs"] <= 0]
+        if released:
+            await db["chunks"].delete_many({"_id": {"$in": released}, "refs": {"$lte": 0}})
+        orphans += [shared[hash_]["chunk"] for hash_ in released]
+        orphans += [chunk for chunk in chunks if isinstance(chunk, dict) and chunk.get("hash") in hashes and chunk["hash"] not in shared]
+
+    await reaper.enqueue_chunks(db, telegram, orphans)
+
+
+async def get_chunks_messages(file_data, telegram):
+    return (await get_files_messages([file_data], telegram))[0]
+
+
+async def get_files_messages(files, telegram):
+    # The chunks of every file are looked up together, a file with a missing chunk gets None
+    located = await telegram.get_messages([chunk for file in files for chunk in file["chunks"]])
+    messages = []
+    start = 0
+    for file in files:
+        file_messages = located[start:start + len(file["chunks"])]
+        start += len(file["chunks"])
+        messages.append(None if any(message is None or message.file is None for session, message, key in file_messages) else file_messages)
+    return messages
+
+
+async def iter_progress(body, total, desc, transfers, transfer):
+    transfers.add(transfer)
+    pbar = tqdm(total=total, unit="B", unit_scale=True, desc=desc)
+    status = "cancelled"
+    try:
+        async for data in body:
+            pbar.update(len(data))
+            transfer.add(len(data))
+            yield data
+        status = "done"
+    except Exception as e:
+        status = "failed"
+        transfer.error = str(e)
+        raise
+    finally:
+        pbar.close()
+        transfers.finish(transfer, status, transfer.error)
+
+
+async def send_stream(body, file_name, size=None, mimetype=None):
+    response = Response(body, mimetype=mimetype or "application/octet-stream")
+    response.headers.add("Content-Disposition", "attachment", filename=file_name)
+    if size is not None:
+        response.content_length = size
+    return response
 
 
 async def merge_similar_files(db, telegram, file_id):
@@ -426,4 +624,22 @@ async def merge_similar_files(db, telegram, file_id):
         if len(similar_files) > 1:
             file_ids = [file["_id"] for file in similar_files]
             await delete_files(file_ids[1:], db, telegram)
-    return utils.make_json_serializable(file_id), code
+    return str(file_id), code
+
+
+async def merge_similar_files_in(db, telegram, directory):
+    # Same rule as merge_similar_files for a whole directory, the oldest file of each group is kept
+    groups = db["files"].aggregate([
+        {"$match": {"directory": directory}},
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": {"name": "$name", "type": "$type", "size": "$size"}, "ids": {"$push": "$_id"}}},
+        {"$match": {"ids.1": {"$exists": True}}},
+    ])
+
+    duplicates = []
+    async for group in groups:
+        duplicates += group["ids"][1:]
+
+    if duplicates:
+        await delete_files(duplicates, db, telegram)
+    return len(duplicates)
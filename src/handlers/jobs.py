@@ -0,0 +1,21 @@
+import bson
+
+
+async def create_upload_job(files, files_data, jobs):
+    if not files:
+        return "No files to upload", 400
+
+    job_id = await jobs.create(files, files_data)
+    return {"job": str(job_id)}, 202
+
+
+async def get_job(job_id, jobs):
+    try:
+        job_id = bson.ObjectId(job_id)
+    except bson.errors.InvalidId:
+        return "Invalid job id", 400
+
+    job = await jobs.get(job_id)
+    if job is None:
+        return "Job not found", 404
+    return job, 200
@@ -1,4 +1,5 @@
 import bson
+import pymongo
 import src.utils as utils
 import src.handlers.files as handlers_files
 
@@ -12,22 +13,83 @@ def get_tags_query(names, parents):
     return query
 
 
-async def get_tags(db, names=None, parents=None, recursive=None):
-    print("get_tags")
+async def get_tags(db, names=None, parents=None, recursive=None, limit=None, after=None, fields=None, stream=None):
+    page = utils.get_page(limit, after)
+    if page is None:
+        return "Invalid limit or after", 400
+    # Descendants are gathered in memory, there is no cursor to page, project or stream
+    if recursive and (limit or after or fields or stream):
+        return "limit, after, fields and stream can't be combined with recursive", 400
+
     query = get_tags_query(names, parents)
-    tags = await db.tags.find(query).to_list(None)
     if recursive:
-        for tag in tags:
-            children, code = await get_tags(db, parents=[tag["_id"]], recursive=True)
-            tags.extend([child for child in children if child not in tags])
+        tags = await db.tags.find(query).to_list(None)
+    else:
+        cursor = utils.find_page(db.tags, query, *page, fields=fields)
+        if stream:
+            return utils.send_ndjson(cursor), 200
+        tags = await cursor.to_list(None)
+
+    if recursive and tags:
+        tags_ids = {tag["_id"] for tag in tags}
+        descendants = await db.tags.find({"ancestors": {"$in": list(tags_ids)}}).to_list(None)
+        tags.extend([descendant for descendant in descendants if descendant["_id"] not in tags_ids])
+
+    return tags, 200
+
+
+async def get_tags_with_descendants(db, tags_ids):
+    # Each tag becomes the list of itself and its descendants, so a file matches with any subtag
+    groups = {tag_id: [tag_id] for tag_id in tags_ids}
+    ancestors = []
+    for tag_id in tags_ids:
+        try:
+            ancestors.append(bson.ObjectId(tag_id))
+        except bson.errors.InvalidId:
+            pass
+
+    async for descendant in db.tags.find({"ancestors": {"$in": ancestors}}, {"ancestors": 1}):
+        for ancestor in descendant["ancestors"]:
+            if str(ancestor) in groups:
+                groups[str(ancestor)].append(str(descendant["_id"]))
+
+    return [groups[tag_id] for tag_id in tags_ids]
+
 
-    return utils.make_json_serializable(tags), 200
+async def get_tag_ancestors(db, parent):
+    if not parent:
+        return []
+    parent_tag = await db.tags.find_one({"_id": parent}, {"ancestors": 1})
+    return (parent_tag.get("ancestors", []) if parent_tag else []) + [parent]
+
+
+async def update_tags_ancestors(db):
+    # Rebuilds every ancestors list from the parents, used to backfill tags created before the lists existed
+    tags = {tag["_id"]: tag async for tag in db.tags.find({}, {"parent": 1, "ancestors": 1})}
+
+    def ancestors(tag):
+        chain = []
+        parent = tag.get("parent")
+        # A parent deleted before its children were moved up is left out, the chain above it is unknown
+        while parent in tags and parent not in chain:
+            chain.append(parent)
+            parent = tags[parent].get("parent")
+        return chain[::-1]
+
+    updates = []
+    for tag_id, tag in tags.items():
+        tag_ancestors = ancestors(tag)
+        if tag.get("ancestors") != tag_ancestors:
+            updates.append(pymongo.UpdateOne({"_id": tag_id}, {"$set": {"ancestors": tag_ancestors}}))
+    if updates:
+        await db.tags.bulk_write(updates, ordered=False)
+    return len(updates)
 
 
 async def get_tag(db, tag_id):
     tag = await db.tags.find_one({"_id": bson.ObjectId(tag_id)})
     if tag:
-        return utils.make_json_serializable(tag), 200
+        return tag, 200
     else:
         return "Tag not found", 404
 
@@ -35,8 +97,8 @@ async def get_tag(db, tag_id):
 async def create_tag(db, name, parent):
     if not name:
         return "Name is required", 400
-    tag = await get_tags(db, names=[name])
-    if tag:
+    tags, code = await get_tags(db, names=[name])
+    if tags:
         return "Tag already exists", 409
     else:
         if parent:
@@ -44,16 +106,23 @@ async def create_tag(db, name, parent):
                 parent = bson.ObjectId(parent)
             except bson.errors.InvalidId:
                 return "Invalid parent id", 400
-        tag = {"name": name, "parent": parent}
+        tag = {"name": name, "parent": parent, "ancestors": await get_tag_ancestors(db, parent)}
         await db.tags.insert_one(tag)
-        return utils.make_json_serializable(tag["_id"]), 200
+        return str(tag["_id"]), 200
+
+
+async def remove_tag(db, tag):
+    # Children move up to the parent of the deleted tag, so parents and ancestors keep describing the same chain
+    await db.tags.delete_one({"_id": tag["_id"]})
+    await db.tags.update_many({"parent": tag["_id"]}, {"$set": {"parent": tag.get("parent")}})
+    await db.tags.update_many({"ancestors": tag["_id"]}, {"$pull": {"ancestors": tag["_id"]}})
 
 
 async def delete_tag(tag_id, db, telegram):
     tag = await db.tags.find_one({"_id": bson.ObjectId(tag_id)})
     if tag:
-        await db.tags.delete_one({"_id": bson.ObjectId(tag_id)})
-        return utils.make_json_serializable(tag["_id"]), 200
+        await remove_tag(db, tag)
+        return str(tag["_id"]), 200
     else:
         return "Tag not found", 404
 
@@ -62,8 +131,8 @@ async def delete_tags(tags_ids, db, telegram):
     for tag_id in tags_ids:
         tag = await db.tags.find_one({"_id": bson.ObjectId(tag_id)})
         if tag:
-            await db.tags.delete_one({"_id": bson.ObjectId(tag_id)})
-    return utils.make_json_serializable(tags_ids), 200
+            await remove_tag(db, tag)
+    return tags_ids, 200
 
 
 async def patch_tag(tag_id, db, telegram, new_name=None, new_parent=None):
@@ -73,9 +142,19 @@ async def patch_tag(tag_id, db, telegram, new_name=None, new_parent=None):
             tag["name"] = new_name
         if new_parent:
             tag["parent"] = bson.ObjectId(new_parent)
+            tag["ancestors"] = await get_tag_ancestors(db, tag["parent"])
+            if tag["_id"] in tag["ancestors"]:
+                return "Tag can't be moved under itself", 400
         await db.tags.update_one({"_id": bson.ObjectId(tag_id)}, {"$set": tag})
+
+        if new_parent:
+            # Descendants keep their path below this tag and take its new ancestors above it
+            await db.tags.update_many({"ancestors": tag["_id"]}, [{"$set": {"ancestors": {"$concatArrays": [
+                tag["ancestors"] + [tag["_id"]],
+                {"$slice": ["$ancestors", {"$add": [{"$indexOfArray": ["$ancestors", tag["_id"]]}, 1]}, {"$size": "$ancestors"}]},
+            ]}}}])
         await merge_similar_tags(db, telegram, tag_id)
-        return utils.make_json_serializable(tag["_id"]), 200
+        return str(tag["_id"]), 200
     else:
         return "Tag not found", 404
 
@@ -84,7 +163,7 @@ async def get_tag_children(tag_id, db, recursive=None):
     tag = await db.tags.find_one({"_id": bson.ObjectId(tag_id)})
     if tag:
         children, code = await get_tags(db, parents=[tag_id], recursive=recursive)
-        return utils.make_json_serializable(children), 200
+        return children, 200
     else:
         return "Tag not found", 404
 
@@ -95,7 +174,7 @@ async def remove_tag_children(tag_id, db, telegram, recursive=None):
         children, code = await get_tags(db, parents=[tag_id], recursive=recursive)
         for child in children:
             await delete_tag(child["_id"], db, telegram)
-        return utils.make_json_serializable(children), 200
+        return children, 200
     else:
         return "Tag not found", 404
 
@@ -107,8 +186,8 @@ async def merge_similar_tags(db, telegram, tag_id):
         parents = [tag["parent"]] if tag["parent"] else []
         similar_tags, code = await get_tags(db, names=[tag["name"]], parents=parents)
         if len(similar_tags) > 1:
-            files, code = await handlers_files.get_files(db, tags=[tag["_id"] for tag in similar_tags])
+            files, code = await handlers_files.get_files(db, tags=[str(tag["_id"]) for tag in similar_tags])
             files_ids = [file["_id"] for file in files]
-            await handlers_files.delete_files_tags(files_ids, db, [tag["_id"] for tag in similar_tags[1:]], telegram)
+            await handlers_files.delete_files_tags(files_ids, db, [str(tag["_id"]) for tag in similar_tags[1:]], telegram)
             await delete_tags([tag["_id"] for tag in similar_tags[1:]], db, telegram)
-        return utils.make_json_serializable(tag["_id"]), 200
+        return str(tag["_id"]), 200
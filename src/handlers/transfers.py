@@ -0,0 +1,19 @@
+from quart import Response
+
+
+async def get_transfer(transfer_id, transfers):
+    transfer = transfers.get(transfer_id)
+    if transfer is None:
+        return "Transfer not found", 404
+    return transfer.snapshot(), 200
+
+
+async def get_transfer_events(transfer_id, transfers):
+    transfer = transfers.get(transfer_id)
+    if transfer is None:
+        return "Transfer not found", 404
+
+    response = Response(transfers.events(transfer), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # proxies must not hold the events back
+    return response, 200
@@ -0,0 +1,121 @@
+import bson
+
+import src.utils as utils
+import src.handlers.files as handlers_files
+
+
+async def create_upload(name, data, size, db, uploads):
+    if not name or size is None:
+        return "Name and size are required", 400
+
+    try:
+        size = int(size)
+        file_data = utils.load_json_from_string(data or "{}")
+    except ValueError:
+        return "Invalid size or data", 400
+
+    if size < 0:
+        return "Invalid size or data", 400
+
+    # Fails early on invalid data or an existing file instead of after the whole upload
+    file_document, code = await handlers_files.get_file_document(name, file_data, db)
+    if code != 200:
+        return file_document, code
+
+    upload = await uploads.create(name, data or "{}", size)
+    return {"upload": str(upload["_id"]), "offset": 0, "size": size}, 201
+
+
+async def get_upload(upload_id, uploads):
+    upload_id, code = parse_upload_id(upload_id)
+    if code != 200:
+        return upload_id, code
+
+    upload, code = await find_upload(upload_id, uploads)
+    if code != 200:
+        return upload, code
+    return {"upload": str(upload["_id"]), "offset": upload["offset"], "size": upload["size"], "chunks": len(upload["chunks"])}, 200
+
+
+async def patch_upload(upload_id, offset, body, uploads):
+    upload_id, code = parse_upload_id(upload_id)
+    if code != 200:
+        return upload_id, code
+
+    async with uploads.lock(upload_id):
+        upload, code = await find_upload(upload_id, uploads)
+        if code != 200:
+            return upload, code
+
+        # The client resumes from the offset it gets back, bytes already stored are never sent twice
+        if offset is None or not offset.isdigit() or int(offset) != upload["offset"]:
+            return {"offset": upload["offset"], "size": upload["size"]}, 409
+
+        async def limited():
+            received = upload["offset"]
+            async for data in body:
+                received += len(data)
+                if received > upload["size"]:
+                    raise ValueError("Body goes past the upload size")
+                yield data
+
+        try:
+            offset = await uploads.append(upload, limited())
+        except ValueError as e:
+            return str(e), 400
+
+    return {"offset": offset, "size": upload["size"]}, 200
+
+
+async def finalize_upload(upload_id, db, telegram, uploads):
+    upload_id, code = parse_upload_id(upload_id)
+    if code != 200:
+        return upload_id, code
+
+    async with uploads.lock(upload_id):
+        upload, code = await find_upload(upload_id, uploads)
+        if code != 200:
+            return upload, code
+
+        if upload["offset"] != upload["size"]:
+            return {"offset": upload["offset"], "size": upload["size"]}, 409
+
+        file_document, code = await handlers_files.get_file_document(upload["name"], utils.load_json_from_string(upload["data"]), db)
+        if code != 200:
+            return file_document, code
+
+        await uploads.commit(upload)
+        res = await db["files"].insert_one({**file_document, "size": file_document["size"] or upload["size"], "chunks": upload["chunks"]})
+        await uploads.remove(upload)
+
+    return str(res.inserted_id), 200
+
+
+async def delete_upload(upload_id, db, telegram, uploads):
+    upload_id, code = parse_upload_id(upload_id)
+    if code != 200:
+        return upload_id, code
+
+    async with uploads.lock(upload_id):
+        upload, code = await find_upload(upload_id, uploads)
+        if code != 200:
+            return upload, code
+
+        await handlers_files.release_chunks(db, telegram, upload["chunks"])
+        await uploads.remove(upload)
+
+    return str(upload_id), 200
+
+
+def parse_upload_id(upload_id):
+    try:
+        return bson.ObjectId(upload_id), 200
+    except bson.errors.InvalidId:
+        return "Invalid upload id", 400
+
+
+async def find_upload(upload_id, uploads):
+    upload = await uploads.get(upload_id)
+    if upload is None:
+        return "Upload not found", 404
+    return upload, 200
@@ -0,0 +1,44 @@
+import pymongo
+
+
+# Applied in order and recorded in the migrations collection, append new versions instead of editing old ones
+MIGRATIONS = [
+    (1, [
+        # Duplicate check on upload, merges and directory filters (prefix)
+        ("files", [("directory", pymongo.ASCENDING), ("name", pymongo.ASCENDING), ("type", pymongo.ASCENDING), ("size", pymongo.ASCENDING)]),
+        ("files", [("tags", pymongo.ASCENDING)]),
+        ("files", [("type", pymongo.ASCENDING)]),
+        # Children lookups, $graphLookup on parent and duplicate names under a parent
+        ("directories", [("parent", pymongo.ASCENDING), ("name", pymongo.ASCENDING)]),
+        ("directories", [("name", pymongo.ASCENDING)]),
+        ("tags", [("parent", pymongo.ASCENDING), ("name", pymongo.ASCENDING)]),
+        ("tags", [("name", pymongo.ASCENDING)]),
+        ("tags", [("ancestors", pymongo.ASCENDING)]),
+    ]),
+    (2, [
+        # Due deletions polled by the reaper
+        ("deletions", [("next_attempt_at", pymongo.ASCENDING)]),
+    ]),
+    (3, [
+        # Files moved by pack compaction
+        ("files", [("chunks.pack", pymongo.ASCENDING)]),
+    ]),
+]
+
+
+async def migrate(db):
+    state = await db.migrations.find_one({"_id": "indexes"})
+    version = state["version"] if state else 0
+
+    for migration_version, indexes in MIGRATIONS:
+        if migration_version <= version:
+            continue
+
+        for collection, keys in indexes:
+            await db[collection].create_index(keys)
+
+        await db.migrations.update_one({"_id": "indexes"}, {"$set": {"version": migration_version}}, upsert=True)
+        version = migration_version
+        print(f"Indexes migrated to version {version}")
+
+    return version
@@ -0,0 +1,182 @@
+from quart.datastructures import FileStorage
+from yaml import safe_load
+import bson
+import datetime as dt
+import asyncio
+import os
+import shutil
+
+import src.utils as utils
+import src.handlers.files as handlers_files
+
+
+class Jobs:
+    def __init__(self, db, telegram, chunker, cache, compressor, packer, transfers):
+        with open("config.yaml", "r") as config_file:
+            config = safe_load(config_file)
+
+        self.db = db
+        self.telegram = telegram
+        self.chunker = chunker
+        self.cache = cache
+        self.compressor = compressor
+        self.packer = packer
+        self.transfers = transfers
+
+        self.path = config.get("jobs_path", "jobs")
+        self.workers = config.get("jobs_workers", 2)
+        self.flush_interval = config.get("jobs_flush_interval", 1)
+
+        self.queue = asyncio.Queue()
+        self.tasks = []
+        # Bytes done per file of the running jobs, flushed to Mongo every flush_interval
+        self.progress = {}
+
+    async def start(self):
+        os.makedirs(self.path, exist_ok=True)
+
+        # Jobs interrupted by a restart start over from their spooled files, finished files are kept
+        async for job in self.db.jobs.find({"status": {"$in": ["pending", "running"]}}, {"_id": 1}).sort("_id", 1):
+            self.queue.put_nowait(job["_id"])
+
+        self.tasks = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def create(self, files, files_data):
+        job_id = bson.ObjectId()
+        job_path = os.path.join(self.path, str(job_id))
+        os.makedirs(job_path)
+
+        job_files = []
+        for index, (file, file_data) in enumerate(zip(files, files_data)):
+            path = os.path.join(job_path, str(index))
+            await file.save(path)
+            job_files.append({
+                "name": file.filename,
+                "data": file_data,
+                "path": path,
+                "size": os.path.getsize(path),
+                "done": 0,
+                "status": "pending",
+                "id": None,
+                "error": None,
+            })
+
+        await self.db.jobs.insert_one({
+            "_id": job_id,
+            "type": "upload",
+            "status": "pending",
+            "created_at": dt.datetime.now(),
+            "started_at": None,
+            "finished_at": None,
+            "files": job_files,
+        })
+        self.queue.put_nowait(job_id)
+        return job_id
+
+    async def get(self, job_id):
+        job = await self.db.jobs.find_one({"_id": job_id}, {"files.path": 0, "files.data": 0})
+        if job is None:
+            return None
+
+        progress = self.progress.get(job_id, {})
+        for index, job_file in enumerate(job["files"]):
+            job_file["done"] = progress.get(index, job_file["done"])
+
+        done = sum(job_file["done"] for job_file in job["files"])
+        elapsed = ((job["finished_at"] or dt.datetime.now()) - job["started_at"]).total_seconds() if job["started_at"] else 0
+        job["size"] = sum(job_file["size"] for job_file in job["files"])
+        job["done"] = done
+        job["throughput"] = done / elapsed if elapsed > 0 else 0
+        return job
+
+    async def work(self):
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self.run(job_id)
+            except Exception as e:
+                print(f"Job {job_id} failed: {e}")
+                transfer = self.transfers.get(str(job_id))
+                if transfer is not None:
+                    self.transfers.finish(transfer, "failed", str(e))
+                await self.db.jobs.update_one({"_id": job_id}, {"$set": {"status": "failed", "finished_at": dt.datetime.now()}})
+            finally:
+                self.progress.pop(job_id, None)
+
+    async def run(self, job_id):
+        job = await self.db.jobs.find_one({"_id": job_id})
+        if job is None or job["status"] not in ("pending", "running"):
+            return
+
+        await self.db.jobs.update_one({"_id": job_id}, {"$set": {"status": "running", "started_at": job["started_at"] or dt.datetime.now()}})
+        progress = self.progress[job_id] = {}
+
+        # Followed on /transfers/<job_id>/events, files finished before a restart count as done
+        transfer = self.transfers.create("upload", f"job {job_id}", sum(job_file["size"] for job_file in job["files"]), str(job_id))
+        transfer.add(sum(job_file["size"] for job_file in job["files"] if job_file["status"] == "done"))
+
+        async def upload(index, job_file, duplicate):
+            def on_progress(done):
+                transfer.add(done - progress.get(index, 0))
+                progress[index] = done
+
+            try:
+                if duplicate:
+                    raise FileExistsError("File already exists")
+                with open(job_file["path"], "rb") as stream:
+                    file = FileStorage(stream, filename=job_file["name"])
+                    file_data = utils.load_json_from_string(job_file["data"])
+                    response, code = await handlers_files.upload_file(file, file_data, self.db, self.telegram, self.chunker, self.cache, self.compressor, self.packer, on_progress=on_progress)
+            except FileExistsError as e:
+                response, code = str(e), 400
+            except Exception as e:
+                response, code = str(e), 500
+
+            update = {f"files.{index}.done": progress.get(index, 0)}
+            if code == 200:
+                on_progress(job_file["size"])
+                update.update({f"files.{index}.status": "done", f"files.{index}.id": response, f"files.{index}.done": job_file["size"]})
+            else:
+                update.update({f"files.{index}.status": "failed", f"files.{index}.error": response})
+            await self.db.jobs.update_one({"_id": job_id}, {"$set": update})
+            os.remove(job_file["path"])
+            return code == 200
+
+        async def flush():
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                if progress:
+                    await self.db.jobs.update_one({"_id": job_id}, {"$set": {f"files.{index}.done": done for index, done in progress.items()}})
+
+        # Files of the job are checked concurrently, so copies of the same file inside it never see each other in Mongo
+        seen = set()
+        duplicates = set()
+        for index, job_file in enumerate(job["files"]):
+            if job_file["status"] == "failed":
+                continue
+            try:
+                key = handlers_files.get_file_key(job_file["name"], utils.load_json_from_string(job_file["data"]))
+            except (ValueError, AttributeError):
+                continue
+            if key in seen:
+                duplicates.add(index)
+            seen.add(key)
+
+        flusher = asyncio.ensure_future(flush())
+        try:
+            # Files share the telegram upload window, so the whole job can be started at once
+            pending = [(index, job_file) for index, job_file in enumerate(job["files"]) if job_file["status"] not in ("done", "failed")]
+            await asyncio.gather(*[upload(index, job_file, index in duplicates) for index, job_file in pending])
+        finally:
+            flusher.cancel()
+
+        job = await self.db.jobs.find_one({"_id": job_id}, {"files.status": 1})
+        status = "done" if all(job_file["status"] == "done" for job_file in job["files"]) else "failed"
+        await self.db.jobs.update_one({"_id": job_id}, {"$set": {"status": status, "finished_at": dt.datetime.now()}})
+        self.transfers.finish(transfer, status)
+        shutil.rmtree(os.path.join(self.path, str(job_id)), ignore_errors=True)
@@ -0,0 +1,17 @@
+from quart.json.provider import DefaultJSONProvider
+import bson
+import datetime as dt
+
+
+def default(value):
+    # Called by the json C encoder only for values it can't serialize itself, documents are never copied
+    if isinstance(value, bson.ObjectId):
+        return str(value)
+    if isinstance(value, dt.datetime):
+        return value.isoformat()
+    return DefaultJSONProvider.default(value)
+
+
+class JSONProvider(DefaultJSONProvider):
+    default = staticmethod(default)
+    sort_keys = False
@@ -0,0 +1,109 @@
+from pymongo import monitoring
+import contextlib
+import contextvars
+import threading
+
+
+# Name: (type, help, histogram buckets)
+DEFINITIONS = {
+    "http_request_duration_seconds": ("histogram", "Time until the response headers are sent, streamed bodies are not included", (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)),
+    "telegram_bytes_total": ("counter", "Bytes sent to or received from Telegram", None),
+    "telegram_transfer_seconds_total": ("counter", "Time spent in Telegram transfers, bytes divided by it is the throughput", None),
+    "telegram_chunks_total": ("counter", "Chunks sent to Telegram and blocks fetched from it", None),
+    "telegram_calls_active": ("gauge", "Telegram calls in progress", None),
+    "transfers_active": ("gauge", "Uploads and downloads in progress", None),
+    "mongo_commands_total": ("counter", "Mongo commands per handler", None),
+    "mongo_command_duration_seconds": ("histogram", "Mongo command duration per handler", (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)),
+}
+
+# Endpoint of the request being served, Motor copies it into the threads running the commands
+handler = contextvars.ContextVar("handler", default="background")
+
+lock = threading.Lock()
+values = {}
+collectors = []
+
+
+def labels_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def inc(name, value=1, **labels):
+    with lock:
+        key = (name, labels_key(labels))
+        values[key] = values.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    buckets = DEFINITIONS[name][2]
+    with lock:
+        key = (name, labels_key(labels))
+        histogram = values.get(key)
+        if histogram is None:
+            histogram = values[key] = {"buckets": [0] * len(buckets), "sum": 0, "count": 0}
+        for index, bound in enumerate(buckets):
+            if value <= bound:
+                histogram["buckets"][index] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+@contextlib.contextmanager
+def active(name, **labels):
+    inc(name, 1, **labels)
+    try:
+        yield
+    finally:
+        inc(name, -1, **labels)
+
+
+def register(collector):
+    # Called on every scrape, returns (name, type, help, [(labels, value)]) for values owned by other components
+    collectors.append(collector)
+
+
+def format_labels(labels):
+    labels = [(name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in labels]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}" if labels else ""
+
+
+def render():
+    with lock:
+        snapshot = {key: dict(value, buckets=list(value["buckets"])) if isinstance(value, dict) else value for key, value in values.items()}
+
+    lines = []
+    for name, (type_, help_, buckets) in DEFINITIONS.items():
+        samples = sorted((labels, value) for (metric, labels), value in snapshot.items() if metric == name)
+        lines += [f"# HELP {name} {help_}", f"# TYPE {name} {type_}"]
+        for labels, value in samples:
+            if type_ != "histogram":
+                lines.append(f"{name}{format_labels(labels)} {value}")
+                continue
+            for bound, count in zip(buckets, value["buckets"]):
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', str(bound)),))} {count}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {value['count']}")
+            lines.append(f"{name}_sum{format_labels(labels)} {value['sum']}")
+            lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+
+    for collector in collectors:
+        for name, type_, help_, samples in collector():
+            lines += [f"# HELP {name} {help_}", f"# TYPE {name} {type_}"]
+            lines += [f"{name}{format_labels(labels_key(labels))} {value}" for labels, value in samples]
+
+    return "\n".join(lines) + "\n"
+
+
+class CommandListener(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.record(event, "succeeded")
+
+    def failed(self, event):
+        self.record(event, "failed")
+
+    def record(self, event, status):
+        labels = {"handler": handler.get(), "command": event.command_name}
+        inc("mongo_commands_total", status=status, **labels)
+        observe("mongo_command_duration_seconds", event.duration_micros / 1e6, **labels)
@@ -0,0 +1,148 @@
+from yaml import safe_load
+import bson
+import pymongo
+import datetime as dt
+import asyncio
+import io
+
+from src.chunker import ChunkStream
+import src.reaper as reaper
+import src.scheduler as scheduler
+
+
+async def release_packed(db, telegram, chunks):
+    # Packs are shared by many files, their message is only deleted once no file is left in them
+    packs = {}
+    for chunk in chunks:
+        files, length = packs.get(chunk["pack"], (0, 0))
+        packs[chunk["pack"]] = (files + 1, length + chunk["length"])
+
+    orphans = []
+    for pack_id, (files, length) in packs.items():
+        pack = await db.packs.find_one_and_update({"_id": pack_id}, {"$inc": {"files": -files, "live": -length}}, return_document=pymongo.ReturnDocument.AFTER)
+        if pack is not None and pack["files"] <= 0:
+            await db.packs.delete_one({"_id": pack_id})
+            orphans.append(pack["chunk"])
+
+    await reaper.enqueue_chunks(db, telegram, orphans)
+
+
+class Packer:
+    def __init__(self, db, telegram, cache):
+        with open("config.yaml", "r") as config_file:
+            config = safe_load(config_file)
+
+        self.db = db
+        self.telegram = telegram
+        self.cache = cache
+
+        self.max_file_size = config.get("pack_max_file_size", 100 * 1024)
+        self.pack_size = config.get("pack_size", 8 * 1024 * 1024)
+        self.delay = config.get("pack_delay", 1)
+        self.compact_ratio = config.get("pack_compact_ratio", 0.5)
+        self.compact_interval = config.get("pack_compact_interval", 60 * 60)
+
+        self.data = bytearray()
+        self.entries = []
+        self.timer = None
+        self.sending = set()
+        self.task = None
+
+    def packable(self, chunks):
+        return len(chunks) == 1 and chunks[0].length <= self.max_file_size
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        self.flush()
+        await asyncio.gather(*self.sending, return_exceptions=True)
+
+    async def add(self, chunk):
+        # Waits until the pack holding the file is sent, which is at most `delay` seconds after it was started
+        chunk.seek(0)
+        data = chunk.read()
+        future = asyncio.get_running_loop().create_future()
+        self.entries.append((future, len(self.data), len(data)))
+        self.data += data
+
+        if len(self.data) >= self.pack_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.delay, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.entries:
+            return
+
+        task = asyncio.ensure_future(self.send(bytes(self.data), self.entries))
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+        self.data = bytearray()
+        self.entries = []
+
+    async def send(self, data, entries):
+        pack_id = bson.ObjectId()
+        stream = ChunkStream(io.BytesIO(data), 0, len(data), f"pack-{pack_id}")
+        try:
+            async with self.telegram.upload_window:
+                record = await self.telegram.send_chunk(stream, caption=f"pack - {len(entries)} files", force_document=True, file_size=len(data))
+            await self.db.packs.insert_one({"_id": pack_id, "chunk": record, "size": len(data), "live": len(data), "files": len(entries), "created_at": dt.datetime.now()})
+        except Exception as e:
+            for future, offset, length in entries:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, offset, length in entries:
+            packed = {**record, "pack": pack_id, "offset": offset, "length": length}
+            await self.cache.put_stream(self.telegram.key(packed), ChunkStream(stream.file, offset, length), length)
+            if not future.done():
+                future.set_result(packed)
+            else:
+                # The upload was abandoned while its pack was being sent
+                await release_packed(self.db, self.telegram, [packed])
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.compact_interval)
+            try:
+                await self.compact()
+            except Exception as e:
+                print(f"Pack compaction failed: {e}")
+
+    async def compact(self):
+        # Packs mostly made of deleted files are rewritten, their live files go to new packs
+        packs = await self.db.packs.find({"$expr": {"$lt": ["$live", {"$multiply": ["$size", self.compact_ratio]}]}}).to_list(None)
+        for pack in packs:
+            await self.compact_pack(pack)
+        return len(packs)
+
+    async def compact_pack(self, pack):
+        files = await self.db.files.find({"chunks.pack": pack["_id"]}, {"chunks": 1}).to_list(None)
+        if files:
+            session, message, key = (await self.telegram.get_messages([pack["chunk"]], scheduler.BACKGROUND))[0]
+            if message is None or message.file is None:
+                print(f"Pack {pack['_id']} is missing from Telegram, leaving it to the reconciler")
+                return
+
+            data = await self.telegram.call(session, "download", scheduler.BACKGROUND, lambda client: client.download_media(message, bytes))
+
+            moves = [(file["_id"], chunk) for file in files for chunk in file["chunks"] if isinstance(chunk, dict) and chunk.get("pack") == pack["_id"]]
+            packed = await asyncio.gather(*[self.add(ChunkStream(io.BytesIO(data), chunk["offset"], chunk["length"])) for file_id, chunk in moves])
+
+            for (file_id, chunk), record in zip(moves, packed):
+                result = await self.db.files.update_one({"_id": file_id, "chunks": chunk}, {"$set": {"chunks.$": record}})
+                if result.modified_count == 0:
+                    # Deleted or changed while it was being moved
+                    await release_packed(self.db, self.telegram, [record])
+
+        await self.db.packs.delete_one({"_id": pack["_id"]})
+        await reaper.enqueue_chunks(self.db, self.telegram, [pack["chunk"]])
@@ -0,0 +1,103 @@
+from telethon.errors import FloodWaitError
+from yaml import safe_load
+import datetime as dt
+import asyncio
+
+import src.scheduler as scheduler
+
+
+async def enqueue_chunks(db, telegram, chunks):
+    # Messages are only deleted by the reaper, callers just record them in the durable queue
+    now = dt.datetime.now()
+    deletions = []
+    for (session, chanel), ids in telegram.group(chunks).items():
+        for message_id in ids:
+            deletions.append({"session": session.name, "chanel": chanel, "message_id": message_id, "attempts": 0, "next_attempt_at": now})
+
+    if deletions:
+        await db.deletions.insert_many(deletions, ordered=False)
+    return len(deletions)
+
+
+class Reaper:
+    def __init__(self, db, telegram):
+        with open("config.yaml", "r") as config_file:
+            config = safe_load(config_file)
+
+        self.db = db
+        self.telegram = telegram
+
+        self.batch_size = 100  # most messages a single delete_messages call accepts
+        self.interval = config.get("deletion_interval", 1)
+        self.idle_interval = config.get("deletion_idle_interval", 5)
+        self.max_backoff = config.get("deletion_max_backoff", 3600)
+
+        self.task = None
+        self.deleted = 0
+        self.batches = 0
+        self.failures = 0
+
+    def stats(self):
+        return {"deleted": self.deleted, "batches": self.batches, "failures": self.failures}
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def run(self):
+        while True:
+            try:
+                deletions = await self.db.deletions.find({"next_attempt_at": {"$lte": dt.datetime.now()}}).sort("_id", 1).limit(self.batch_size * 10).to_list(None)
+            except Exception as e:
+                print(f"Deletion queue unavailable: {e}")
+                deletions = []
+
+            if not deletions:
+                await asyncio.sleep(self.idle_interval)
+                continue
+
+            groups = {}
+            for deletion in deletions:
+                groups.setdefault((deletion["session"], deletion["chanel"]), []).append(deletion)
+
+            for (session_name, chanel), group in groups.items():
+                for start in range(0, len(group), self.batch_size):
+                    # A Mongo error must not end the task, the batch stays queued and is picked up again
+                    try:
+                        await self.delete(session_name, chanel, group[start:start + self.batch_size])
+                    except Exception as e:
+                        self.failures += 1
+                        print(f"Deletion batch failed: {e}")
+                        await asyncio.sleep(self.idle_interval)
+                    await asyncio.sleep(self.interval)
+
+    async def delete(self, session_name, chanel, deletions):
+        ids = [deletion["_id"] for deletion in deletions]
+        session = self.telegram.sessions.get(session_name)
+        if session is None:
+            # The session is no longer configured, retrying would never succeed
+            print(f"Dropping {len(ids)} deletions for unknown session {session_name}")
+            await self.db.deletions.delete_many({"_id": {"$in": ids}})
+            return
+
+        try:
+            message_ids = [deletion["message_id"] for deletion in deletions]
+            await self.telegram.call(session, "delete_messages", scheduler.BACKGROUND, lambda client: client.delete_messages(chanel, message_ids))
+        except FloodWaitError:
+            # Not the batch's fault, the scheduler holds deletions back until Telegram allows them again
+            return
+        except Exception as e:
+            self.failures += 1
+            attempts = max(deletion["attempts"] for deletion in deletions) + 1
+            next_attempt_at = dt.datetime.now() + dt.timedelta(seconds=min(2 ** attempts, self.max_backoff))
+            print(f"Failed to delete {len(ids)} messages from {chanel}: {e}")
+            await self.db.deletions.update_many({"_id": {"$in": ids}}, {"$inc": {"attempts": 1}, "$set": {"next_attempt_at": next_attempt_at}})
+            return
+
+        await self.db.deletions.delete_many({"_id": {"$in": ids}})
+        self.deleted += len(ids)
+        self.batches += 1
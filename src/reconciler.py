@@ -0,0 +1,163 @@
+from telethon.errors import FloodWaitError
+from yaml import safe_load
+import argparse
+import asyncio
+import bisect
+import datetime as dt
+import re
+
+from src.telegram import Telegram
+from src.database import Database
+import src.reaper as reaper
+
+
+# Captions of the messages this server sends: chunks of a file, chunks of a resumable upload and packs
+CAPTION = re.compile(r"(.* - \d+(/\d+)?|pack - \d+ files)", re.DOTALL)
+
+
+class Reconciler:
+    def __init__(self, db, telegram):
+        with open("config.yaml", "r") as config_file:
+            config = safe_load(config_file)
+
+        self.db = db
+        self.telegram = telegram
+
+        self.batch_size = config.get("reconciler_batch_size", 1000)
+        self.page_size = 100  # most messages a single history request returns
+        # Chunks of an upload in progress are only referenced once its file is inserted, recent messages are left alone
+        self.grace = config.get("reconciler_grace", 24 * 60 * 60)
+
+    async def references(self):
+        # Sorted message ids referenced by Mongo, per session name and channel
+        references = {}
+
+        def add(chunk):
+            session, chanel, message_id = self.telegram.locate(chunk)
+            name = chunk["session"] if isinstance(chunk, dict) else session.name
+            references.setdefault((name, chanel), set()).add(message_id)
+
+        async for file in self.db.files.find({}, {"chunks": 1}):
+            for chunk in file["chunks"]:
+                add(chunk)
+        async for upload in self.db.uploads.find({}, {"chunks": 1}):
+            for chunk in upload["chunks"]:
+                add(chunk)
+        async for shared in self.db.chunks.find({}, {"chunk": 1}):
+            add(shared["chunk"])
+        async for pack in self.db.packs.find({}, {"chunk": 1}):
+            add(pack["chunk"])
+        # Already queued for deletion, the reaper takes care of them
+        async for deletion in self.db.deletions.find({}, {"session": 1, "chanel": 1, "message_id": 1}):
+            references.setdefault((deletion["session"], deletion["chanel"]), set()).add(deletion["message_id"])
+
+        return {key: sorted(ids) for key, ids in references.items()}
+
+    def owners_query(self, session, chanel, ids):
+        query = {"chunks": {"$elemMatch": {"session": session.name, "chanel": chanel, "id": {"$in": ids}}}}
+        if session is self.telegram.primary and chanel == self.telegram.chanel_name:
+            query = {"$or": [query, {"chunks": {"$in": ids}}]}
+        return query
+
+    async def run(self, delete=False, restart=False):
+        references = await self.references()
+
+        chanels = {(session.name, chanel) for session in self.telegram.sessions.values() for chanel in session.chanels}
+        for name, chanel in sorted(chanels | set(references), key=str):
+            session = self.telegram.sessions.get(name)
+            if session is None:
+                print(f"{len(references[(name, chanel)])} chunks reference unknown session {name}")
+                continue
+            await self.scan(session, chanel, references.get((name, chanel), []), delete, restart)
+
+    async def scan(self, session, chanel, referenced, delete, restart):
+        checkpoint_id = f"{session.name}/{chanel}"
+        if restart:
+            await self.db.reconciler.delete_one({"_id": checkpoint_id})
+
+        checkpoint = await self.db.reconciler.find_one({"_id": checkpoint_id}) or {}
+        last_id = checkpoint.get("last_id", 0)
+        cutoff = dt.datetime.now(dt.timezone.utc) - dt.timedelta(seconds=self.grace)
+        print(f"Scanning {checkpoint_id} from message {last_id}")
+
+        messages = []
+        min_id = last_id
+        recent = False
+        while not recent:
+            # One scheduler token per page, a FloodWait only delays the next page instead of ending the scan
+            try:
+                async with self.telegram.use(session, "iter_messages") as client:
+                    # Oldest first, so the checkpoint always covers every message below it
+                    page = await client.get_messages(chanel, limit=self.page_size, min_id=min_id, reverse=True)
+            except FloodWaitError as e:
+                print(f"Scanning {checkpoint_id} paused for {e.seconds} seconds")
+                continue
+            if not page:
+                break
+
+            min_id = page[-1].id
+            for message in page:
+                if message.date > cutoff:
+                    recent = True
+                    break
+                messages.append(message)
+                if len(messages) >= self.batch_size:
+                    last_id = await self.check(session, chanel, messages, referenced, last_id, delete)
+                    messages = []
+
+        if messages:
+            await self.check(session, chanel, messages, referenced, last_id, delete)
+
+    async def check(self, session, chanel, messages, referenced, last_id, delete):
+        high_id = messages[-1].id
+        present = {message.id for message in messages}
+        unreferenced = [message for message in messages if message.file is not None and not self.contains(referenced, message.id)]
+        # Channels may be shared, a message this server did not write is reported but never deleted
+        orphans = [message.id for message in unreferenced if CAPTION.fullmatch(message.message or "")]
+        foreign = [message.id for message in unreferenced if not CAPTION.fullmatch(message.message or "")]
+        dangling = [message_id for message_id in referenced[bisect.bisect_right(referenced, last_id):bisect.bisect_right(referenced, high_id)] if message_id not in present]
+
+        if orphans:
+            print(f"{session.name}/{chanel}: {len(orphans)} orphaned messages {orphans}")
+            if delete:
+                await reaper.enqueue_chunks(self.db, self.telegram, [{"session": session.name, "chanel": chanel, "id": message_id} for message_id in orphans])
+
+        if foreign:
+            print(f"{session.name}/{chanel}: {len(foreign)} foreign messages {foreign}, left alone")
+
+        if dangling:
+            query = self.owners_query(session, chanel, dangling)
+            files = [str(file["_id"]) async for file in self.db.files.find(query, {"_id": 1})]
+            print(f"{session.name}/{chanel}: {len(dangling)} missing messages {dangling} referenced by files {files}")
+            if delete:
+                # Files keep their other chunks and are flagged, deduplicated chunks must not be reused by new uploads
+                await self.db.files.update_many(query, {"$set": {"missing_chunks": True}})
+                await self.db.chunks.delete_many({"chunk.session": session.name, "chunk.chanel": chanel, "chunk.id": {"$in": dangling}})
+
+        await self.db.reconciler.update_one(
+            {"_id": f"{session.name}/{chanel}"},
+            {"$set": {"last_id": high_id, "updated_at": dt.datetime.now()}, "$inc": {"scanned": len(messages), "orphans": len(orphans), "foreign": len(foreign), "dangling": len(dangling)}},
+            upsert=True,
+        )
+        return high_id
+
+    @staticmethod
+    def contains(ids, message_id):
+        index = bisect.bisect_left(ids, message_id)
+        return index < len(ids) and ids[index] == message_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the Telegram channels with the chunks referenced in Mongo")
+    parser.add_argument("--delete", action="store_true", help="queue orphaned messages sent by this server for deletion and flag files with missing chunks")
+    parser.add_argument("--restart", action="store_true", help="scan the channels from the beginning instead of the last checkpoint")
+    args = parser.parse_args()
+
+    telegram = Telegram()
+    db = Database().db
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(Reconciler(db, telegram).run(args.delete, args.restart))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+from yaml import safe_load
+import asyncio
+import heapq
+import itertools
+import time
+
+
+INTERACTIVE = 0  # downloads a client is waiting on
+UPLOAD = 1
+BACKGROUND = 2  # deletions, compaction, reconciliation
+
+PRIORITIES = {INTERACTIVE: "interactive", UPLOAD: "upload", BACKGROUND: "background"}
+
+# Calls per second and burst of every method, per session
+RATE_LIMITS = {
+    "send_file": (2, 8),
+    "get_messages": (10, 20),
+    "download": (30, 60),
+    "delete_messages": (1, 3),
+    "iter_messages": (1, 1),
+}
+
+
+class Bucket:
+    def __init__(self, rate, burst):
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.last_flood = 0
+
+        self.waiters = []
+        self.dispatcher = None
+
+        self.calls = 0
+        self.waited = 0
+        self.wait_time = 0
+        self.flood_waits = 0
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        # Seconds until a call may start
+        self.refill(now)
+        return max(self.blocked_until - now, (1 - self.tokens) / self.rate if self.tokens < 1 else 0, 0)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "rate": self.rate,
+            "tokens": self.tokens,
+            "queued": len(self.waiters),
+            "calls": self.calls,
+            "waited": self.waited,
+            "wait_time": self.wait_time,
+            "average_wait_time": self.wait_time / self.waited if self.waited else 0,
+            "flood_waits": self.flood_waits,
+            "blocked_for": max(self.blocked_until - now, 0),
+        }
+
+
+class Scheduler:
+    def __init__(self):
+        with open("config.yaml", "r") as config_file:
+            config = safe_load(config_file)
+
+        self.rate_limits = {**RATE_LIMITS, **{method: tuple(limit) for method, limit in (config.get("telegram_rate_limits") or {}).items()}}
+        self.min_rate_factor = config.get("flood_min_rate_factor", 0.1)
+        self.recovery_time = config.get("flood_recovery_time", 300)
+        self.poll_interval = 0.05
+
+        self.buckets = {}
+        self.sequence = itertools.count()
+        # Interactive calls queued per session, lower priorities of the same session wait for them
+        self.interactive = {}
+        self.priority_wait_time = {name: 0 for name in PRIORITIES.values()}
+
+    def stats(self):
+        return {
+            "buckets": {f"{session}/{method}": bucket.stats() for (session, method), bucket in self.buckets.items()},
+            "wait_time": self.priority_wait_time,
+        }
+
+    def bucket(self, session, method):
+        bucket = self.buckets.get((session, method))
+        if bucket is None:
+            rate, burst = self.rate_limits.get(method, (5, 10))
+            bucket = self.buckets[session, method] = Bucket(rate, burst)
+        return bucket
+
+    async def acquire(self, session, method, priority):
+        bucket = self.bucket(session, method)
+        now = time.monotonic()
+        self.recover(bucket, now)
+        bucket.calls += 1
+
+        if not bucket.waiters and bucket.delay(now) == 0 and (priority == INTERACTIVE or not self.interactive.get(session)):
+            bucket.tokens -= 1
+            return 0
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(bucket.waiters, (priority, next(self.sequence), future))
+        if priority == INTERACTIVE:
+            self.interactive[session] = self.interactive.get(session, 0) + 1
+        if bucket.dispatcher is None or bucket.dispatcher.done():
+            bucket.dispatcher = asyncio.ensure_future(self.dispatch(session, bucket))
+
+        try:
+            await future
+        finally:
+            if priority == INTERACTIVE:
+                self.interactive[session] -= 1
+
+        waited = time.monotonic() - now
+        bucket.waited += 1
+        bucket.wait_time += waited
+        self.priority_wait_time[PRIORITIES[priority]] += waited
+        return waited
+
+    async def dispatch(self, session, bucket):
+        # Hands the tokens of a bucket to its waiters by priority, then arrival order
+        while bucket.waiters:
+            priority, sequence, future = bucket.waiters[0]
+            if future.done():
+                heapq.heappop(bucket.waiters)
+                continue
+
+            delay = bucket.delay(time.monotonic())
+            if delay == 0 and priority != INTERACTIVE and self.interactive.get(session):
+                delay = self.poll_interval
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            heapq.heappop(bucket.waiters)
+            bucket.tokens -= 1
+            future.set_result(None)
+
+    def flood(self, session, method, seconds):
+        # Telegram said how long to wait, the bucket is also slowed down so the next burst does not hit it again
+        bucket = self.bucket(session, method)
+        now = time.monotonic()
+        bucket.flood_waits += 1
+        bucket.blocked_until = max(bucket.blocked_until, now + seconds)
+        bucket.rate = max(bucket.rate / 2, bucket.base_rate * self.min_rate_factor)
+        bucket.tokens = 0
+        bucket.updated = now
+        bucket.last_flood = now
+
+    def recover(self, bucket, now):
+        # The rate doubles back towards its limit for every recovery_time without a FloodWait
+        if bucket.rate < bucket.base_rate and now - bucket.last_flood >= self.recovery_time:
+            bucket.rate = min(bucket.rate * 2, bucket.base_rate)
+            bucket.last_flood = now
@@ -1,17 +1,194 @@
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+import asyncio
+import contextlib
+import itertools
+import time
+import types
 from yaml import safe_load
 
+from src.scheduler import Scheduler, INTERACTIVE, UPLOAD, BACKGROUND
+import src.metrics as metrics
+
+
+class Session:
+    def __init__(self, name, client, chanels):
+        self.name = name
+        self.client = client
+        self.chanels = chanels
+        self.next_chanel = itertools.cycle(chanels)
+
+        self.load = 0
+        self.operations = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.unhealthy_until
+
+    def stats(self):
+        return {
+            "chanels": self.chanels,
+            "healthy": self.healthy,
+            "load": self.load,
+            "operations": self.operations,
+            "failures": self.failures,
+        }
+
+
+class Slice:
+    # A file packed with others, seen as a message of its own whose reads are shifted into the pack
+    def __init__(self, message, offset, length):
+        self.message = message
+        self.media = message.media
+        self.offset = offset
+        self.file = message.file and types.SimpleNamespace(size=length)
+
 
 class Telegram:
     def __init__(self):
         with open("config.yaml", "r") as config_file:
             config = safe_load(config_file)
 
-        telegram_api_id = config["telegram_api_id"]
-        telegram_api_hash = config["telegram_api_hash"]
+        # A single account is the same as a pool of one session
+        sessions_config = config.get("telegram_sessions") or [{"session": "session"}]
+        chanels = config.get("telegram_chanels") or [config["telegram_chanel"]]
+
+        self.sessions = {}
+        for session_config in sessions_config:
+            name = session_config["session"]
+            client = TelegramClient(name, session_config.get("api_id", config.get("telegram_api_id")), session_config.get("api_hash", config.get("telegram_api_hash")))
+            client.start()
+            # Short FloodWaits, on a single file part for instance, are slept through and retried inside Telethon.
+            # Longer ones reach the scheduler, which holds the method back for the whole session
+            client.flood_sleep_threshold = config.get("flood_sleep_threshold", 10)
+            self.sessions[name] = Session(name, client, session_config.get("chanels", chanels))
 
-        self.client = TelegramClient("session", telegram_api_id, telegram_api_hash)
-        self.client.start()
+        self.primary = next(iter(self.sessions.values()))
+        self.client = self.primary.client
+        self.chanel_name = self.primary.chanels[0]
 
         self.max_file_size = int(1024 * 1024 * 1024 * 1.5)  # 1.5 GB
-        self.chanel_name = config["telegram_chanel"]
+        self.unhealthy_after = config.get("session_unhealthy_after", 3)
+        self.unhealthy_cooldown = config.get("session_unhealthy_cooldown", 60)
+
+        # Shared by every chunk of every upload in the process, each session adds its own share of concurrency
+        self.upload_concurrency = config.get("upload_concurrency", 4)
+        self.upload_window = asyncio.Semaphore(self.upload_concurrency * len(self.sessions))
+
+        self.download_window = config.get("download_concurrency", 8)
+        self.download_block_size = config.get("download_block_size", 1024 * 1024)
+
+        self.scheduler = Scheduler()
+        self.messages_batch_size = 100  # most ids a single GetMessages request accepts
+        self.flood_retries = config.get("flood_retries", 3)
+
+        self.chunking = config.get("chunking", "fixed")
+        self.cdc_average_size = config.get("cdc_average_size", 64 * 1024 * 1024)
+
+    def stats(self):
+        return {name: session.stats() for name, session in self.sessions.items()}
+
+    def pick(self):
+        sessions = [session for session in self.sessions.values() if session.healthy] or list(self.sessions.values())
+        session = min(sessions, key=lambda session: (session.load, session.operations))
+        return session, next(session.next_chanel)
+
+    def locate(self, chunk):
+        if isinstance(chunk, dict):
+            return self.sessions.get(chunk["session"]), chunk["chanel"], chunk["id"]
+
+        # Chunks stored before the pool existed are plain message ids on the primary session
+        return self.primary, self.chanel_name, chunk
+
+    def key(self, chunk):
+        session, chanel, message_id = self.locate(chunk)
+        key = f"{session.name if session else None}-{chanel}-{message_id}"
+        return f"{key}-{chunk['offset']}" if isinstance(chunk, dict) and "pack" in chunk else key
+
+    def group(self, chunks):
+        groups = {}
+        for chunk in chunks:
+            session, chanel, message_id = self.locate(chunk)
+            if session is not None:
+                groups.setdefault((session, chanel), []).append(message_id)
+        return groups
+
+    @contextlib.asynccontextmanager
+    async def use(self, session, method, priority=BACKGROUND):
+        # Every Telegram call waits for its turn in the scheduler, by method and priority.
+        # Queued calls already count in the load, so concurrent picks spread over the sessions
+        session.load += 1
+        try:
+            await self.scheduler.acquire(session.name, method, priority)
+        except BaseException:
+            session.load -= 1
+            raise
+
+        session.operations += 1
+        try:
+            with metrics.active("telegram_calls_active", session=session.name, method=method):
+                yield session.client
+        except FloodWaitError as e:
+            self.scheduler.flood(session.name, method, e.seconds)
+            raise
+        except Exception:
+            session.failures += 1
+            session.consecutive_failures += 1
+            if session.consecutive_failures >= self.unhealthy_after:
+                session.unhealthy_until = time.monotonic() + self.unhealthy_cooldown
+            raise
+        else:
+            session.consecutive_failures = 0
+        finally:
+            session.load -= 1
+
+    async def call(self, session, method, priority, function):
+        # Runs function(client), retried after the FloodWaits it runs into since the scheduler holds the next attempt back
+        for attempt in itertools.count():
+            try:
+                async with self.use(session, method, priority) as client:
+                    return await function(client)
+            except FloodWaitError:
+                if attempt >= self.flood_retries:
+                    raise
+
+    async def send_chunk(self, chunk, priority=UPLOAD, **kwargs):
+        session, chanel = self.pick()
+
+        async def send(client):
+            chunk.seek(0)
+            return await client.send_file(chanel, chunk, **kwargs)
+
+        start = time.monotonic()
+        message = await self.call(session, "send_file", priority, send)
+        metrics.inc("telegram_bytes_total", chunk.length, direction="upload")
+        metrics.inc("telegram_transfer_seconds_total", time.monotonic() - start, direction="upload")
+        metrics.inc("telegram_chunks_total", direction="upload")
+        return {"id": message.id, "session": session.name, "chanel": chanel}
+
+    async def get_messages(self, chunks, priority=INTERACTIVE):
+        messages = {}
+        for (session, chanel), ids in self.group(chunks).items():
+            # One scheduler token per request actually sent to Telegram
+            ids = list(dict.fromkeys(ids))
+            for start in range(0, len(ids), self.messages_batch_size):
+                batch = ids[start:start + self.messages_batch_size]
+                found = await self.call(session, "get_messages", priority, lambda client: client.get_messages(chanel, ids=batch))
+                for message_id, message in zip(batch, found):
+                    messages[session.name, chanel, message_id] = message
+
+        located = []
+        for chunk in chunks:
+            session, chanel, message_id = self.locate(chunk)
+            message = messages[session.name, chanel, message_id] if session else None
+            if message is not None and isinstance(chunk, dict) and "pack" in chunk:
+                message = Slice(message, chunk["offset"], chunk["length"])
+            located.append((session, message, self.key(chunk)))
+        return located
+
+    async def delete_chunks(self, chunks):
+        for (session, chanel), ids in self.group(chunks).items():
+            await self.call(session, "delete_messages", BACKGROUND, lambda client: client.delete_messages(chanel, ids))
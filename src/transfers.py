@@ -0,0 +1,127 @@
+from yaml import safe_load
+import asyncio
+import json
+import secrets
+import time
+
+import src.json_provider as json_provider
+
+
+class Transfer:
+    def __init__(self, transfer_id, kind, name, total, throttle):
+        self.id = transfer_id
+        self.kind = kind
+        self.name = name
+        self.total = total
+        self.throttle = throttle
+
+        self.done = 0
+        self.status = "running"
+        self.error = None
+        self.started = time.monotonic()
+        self.finished = None
+
+        self.throughput = 0
+        self.published = self.started
+        self.published_done = 0
+        # Replaced on every publish, subscribers wait on the one they saw last
+        self.changed = asyncio.Event()
+
+    def update(self, done):
+        # Called from Telethon progress callbacks, only every `throttle` seconds wakes the subscribers up
+        self.done = done
+        now = time.monotonic()
+        if now - self.published >= self.throttle:
+            self.publish(now)
+
+    def add(self, length):
+        self.update(self.done + length)
+
+    def finish(self, status="done", error=None):
+        if self.finished is not None:
+            return
+        self.status = status
+        self.error = error
+        self.finished = time.monotonic()
+        self.publish(self.finished)
+
+    def publish(self, now):
+        elapsed = now - self.published
+        if elapsed > 0:
+            rate = (self.done - self.published_done) / elapsed
+            self.throughput = rate if self.published_done == 0 else 0.7 * self.throughput + 0.3 * rate
+        self.published = now
+        self.published_done = self.done
+
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def snapshot(self):
+        elapsed = (self.finished or time.monotonic()) - self.started
+        remaining = self.total - self.done if self.total is not None else None
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "name": self.name,
+            "status": self.status,
+            "error": self.error,
+            "total": self.total,
+            "done": self.done,
+            "elapsed": elapsed,
+            "throughput": self.throughput,
+            "average_throughput": self.done / elapsed if elapsed > 0 else 0,
+            "eta": remaining / self.throughput if remaining is not None and self.throughput > 0 and self.finished is None else None,
+        }
+
+
+class Transfers:
+    def __init__(self):
+        with open("config.yaml", "r") as config_file:
+            config = safe_load(config_file)
+
+        self.throttle = config.get("transfers_throttle", 0.5)
+        self.keep = config.get("transfers_keep", 60)
+        self.heartbeat = 15
+
+        self.transfers = {}
+
+    def create(self, kind, name, total=None, transfer_id=None):
+        transfer = self.new(kind, name, total, transfer_id)
+        self.add(transfer)
+        return transfer
+
+    def new(self, kind, name, total=None, transfer_id=None):
+        # Not registered yet, streamed downloads are only added once their body is iterated, so a body that never starts is never left running
+        return Transfer(transfer_id or secrets.token_hex(8), kind, name, total, self.throttle)
+
+    def add(self, transfer):
+        existing = self.transfers.get(transfer.id)
+        if existing is not None and existing.finished is None:
+            raise ValueError(f"Transfer {transfer.id} is already running")
+        self.transfers[transfer.id] = transfer
+
+    def get(self, transfer_id):
+        return self.transfers.get(transfer_id)
+
+    def finish(self, transfer, status="done", error=None):
+        # Finished transfers stay around for a while, so clients that subscribe late still get the outcome
+        transfer.finish(status, error)
+        asyncio.get_running_loop().call_later(self.keep, self.forget, transfer)
+
+    def forget(self, transfer):
+        if self.transfers.get(transfer.id) is transfer:
+            del self.transfers[transfer.id]
+
+    async def events(self, transfer):
+        while True:
+            changed = transfer.changed
+            event = "end" if transfer.finished is not None else "progress"
+            yield f"event: {event}\ndata: {json.dumps(transfer.snapshot(), default=json_provider.default)}\n\n".encode()
+            if transfer.finished is not None:
+                return
+
+            # Snapshots are coalesced, a slow client only ever gets the latest one
+            try:
+                await asyncio.wait_for(changed.wait(), self.heartbeat)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,137 @@
+from yaml import safe_load
+import datetime as dt
+import asyncio
+import os
+
+from src.chunker import ChunkStream
+import src.handlers.files as handlers_files
+
+
+class Uploads:
+    def __init__(self, db, telegram, cache):
+        with open("config.yaml", "r") as config_file:
+            config = safe_load(config_file)
+
+        self.db = db
+        self.telegram = telegram
+        self.cache = cache
+
+        self.path = config.get("uploads_path", "uploads")
+        self.chunk_size = config.get("uploads_chunk_size", telegram.max_file_size)
+        self.expiry = config.get("uploads_expiry", 7 * 24 * 60 * 60)
+        self.expire_interval = config.get("uploads_expire_interval", 60 * 60)
+
+        self.locks = {}
+        self.task = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.expire_interval)
+            try:
+                await self.expire()
+            except Exception as e:
+                print(f"Upload expiry failed: {e}")
+
+    async def expire(self):
+        # Abandoned uploads release their sent chunks and their buffer, their messages are no longer referenced
+        cutoff = dt.datetime.now() - dt.timedelta(seconds=self.expiry)
+        expired = 0
+        async for upload in self.db.uploads.find({"updated_at": {"$lt": cutoff}}):
+            lock = self.lock(upload["_id"])
+            if lock.locked():
+                continue
+            async with lock:
+                # updated_at only moves when a chunk is sent, bytes still arriving in the buffer keep the upload alive
+                path = self.buffer_path(upload)
+                if os.path.exists(path) and dt.datetime.fromtimestamp(os.path.getmtime(path)) >= cutoff:
+                    continue
+                await handlers_files.release_chunks(self.db, self.telegram, upload["chunks"])
+                await self.remove(upload)
+                expired += 1
+        return expired
+
+    def buffer_path(self, upload):
+        # Named after the committed offset, a buffer left behind by a crash after its chunk was recorded is never reused
+        return os.path.join(self.path, f"{upload['_id']}-{upload['committed']}")
+
+    def offset(self, upload):
+        path = self.buffer_path(upload)
+        return upload["committed"] + (os.path.getsize(path) if os.path.exists(path) else 0)
+
+    def lock(self, upload_id):
+        return self.locks.setdefault(upload_id, asyncio.Lock())
+
+    async def create(self, name, data, size):
+        upload = {
+            "name": name,
+            "data": data,
+            "size": size,
+            "chunk_size": self.chunk_size,
+            "committed": 0,
+            "chunks": [],
+            "created_at": dt.datetime.now(),
+            "updated_at": dt.datetime.now(),
+        }
+        await self.db.uploads.insert_one(upload)
+        open(self.buffer_path(upload), "wb").close()
+        return upload
+
+    async def get(self, upload_id):
+        upload = await self.db.uploads.find_one({"_id": upload_id})
+        if upload is not None:
+            upload["offset"] = self.offset(upload)
+        return upload
+
+    async def append(self, upload, body):
+        # Bytes are appended to the buffer as they arrive, every full chunk goes to Telegram and is recorded right away
+        buffer = open(self.buffer_path(upload), "ab")
+        try:
+            async for data in body:
+                while data:
+                    space = upload["chunk_size"] - buffer.tell()
+                    buffer.write(data[:space])
+                    data = data[space:]
+                    if buffer.tell() == upload["chunk_size"]:
+                        buffer.close()
+                        await self.commit(upload)
+                        buffer = open(self.buffer_path(upload), "ab")
+        finally:
+            # Whatever arrived before a disconnect stays in the buffer and counts in the offset
+            buffer.close()
+
+        return self.offset(upload)
+
+    async def commit(self, upload):
+        path = self.buffer_path(upload)
+        length = os.path.getsize(path)
+        if length == 0:
+            return
+
+        with open(path, "rb") as buffer:
+            chunk = ChunkStream(buffer, 0, length, upload["name"])
+            async with self.telegram.upload_window:
+                record = await self.telegram.send_chunk(chunk, caption=f"{upload['name']} - {len(upload['chunks']) + 1}", force_document=True, file_size=length)
+            await self.cache.put_stream(self.telegram.key(record), chunk, length)
+
+        upload["chunks"].append(record)
+        upload["committed"] += length
+        await self.db.uploads.update_one({"_id": upload["_id"]}, {"$push": {"chunks": record}, "$set": {"committed": upload["committed"], "updated_at": dt.datetime.now()}})
+
+        os.remove(path)
+        open(self.buffer_path(upload), "wb").close()
+
+    async def remove(self, upload):
+        await self.db.uploads.delete_one({"_id": upload["_id"]})
+        path = self.buffer_path(upload)
+        if os.path.exists(path):
+            os.remove(path)
+        self.locks.pop(upload["_id"], None)
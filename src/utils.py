@@ -1,20 +1,10 @@
 import bson
 import json
+from quart import Response
 import datetime as dt
 import shutil
 
-
-def make_json_serializable(data):
-    if isinstance(data, list):
-        return [make_json_serializable(item) for item in data]
-    elif isinstance(data, dict):
-        return {key: make_json_serializable(value) for key, value in data.items()}
-    elif isinstance(data, bson.ObjectId):
-        return str(data)
-    elif isinstance(data, dt.datetime):
-        return data.isoformat()
-    else:
-        return data
+import src.json_provider as json_provider
 
 
 def load_json_from_string(string):
@@ -29,9 +19,85 @@ def clear_temp_folder():
     shutil.os.mkdir(path)
 
 
+def get_stream_size(stream):
+    stream.seek(0, shutil.os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+
+def get_folder_size(path):
+    size = 0
+    for root, directories, files in shutil.os.walk(path):
+        for name in files:
+            try:
+                size += shutil.os.path.getsize(shutil.os.path.join(root, name))
+            except OSError:
+                pass
+    return size
+
+
 def rename_duplicates(names):
-    names = names.copy()
-    for i in range(len(names)):
-        if names[i] in names[:i]:
-            names[i] = f"{names[i]} ({names[:i].count(names[i])})"
-    return names
+    counts = {}
+    renamed = []
+    for name in names:
+        count = counts.get(name, 0)
+        counts[name] = count + 1
+        renamed.append(f"{name} ({count})" if count else name)
+    return renamed
+
+
+
+def get_satisfiable_ranges(range_, size):
+    ranges = []
+    for begin, end in range_.ranges:
+        if begin < 0:
+            start, stop = max(size + begin, 0), size
+        else:
+            start, stop = begin, min(end, size) if end is not None else size
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
+
+
+def if_range_matches(if_range, etag, last_modified):
+    if if_range is None or (if_range.etag is None and if_range.date is None):
+        return True
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if not isinstance(last_modified, dt.datetime):
+        return False
+    return if_range.date.replace(tzinfo=None) == last_modified.replace(microsecond=0, tzinfo=None)
+
+
+def get_page(limit=None, after=None):
+    # Returns (limit, after) ready for find_page, or None when they are not valid
+    try:
+        limit = int(limit) if limit else None
+        after = bson.ObjectId(after) if after else None
+    except (ValueError, bson.errors.InvalidId):
+        return None
+    if limit is not None and limit <= 0:
+        return None
+    return limit, after
+
+
+def find_page(collection, query, limit=None, after=None, fields=None):
+    # Pages are keyed on _id so the next one starts after the last _id received, whatever was inserted meanwhile
+    if after is not None:
+        query = {**query, "_id": {"$gt": after}}
+    cursor = collection.find(query, {field: 1 for field in fields} if fields else None)
+    if limit is not None or after is not None:
+        cursor = cursor.sort("_id", 1)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    return cursor
+
+
+def send_ndjson(cursor):
+    # One document per line, written as the cursor yields them
+    async def lines():
+        async for document in cursor:
+            yield json.dumps(document, default=json_provider.default) + "\n"
+
+    return Response(lines(), mimetype="application/x-ndjson")
@@ -1,9 +1,78 @@
-import zipfile
+import datetime as dt
+import struct
+import zlib
+
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_VERSION = 45
+FLAGS = 0x08 | 0x800  # sizes in data descriptor, UTF-8 names
+
+
+def dos_date_time(date):
+    if not isinstance(date, dt.datetime) or date.year < 1980:
+        date = dt.datetime(1980, 1, 1)
+    return (date.year - 1980) << 9 | date.month << 5 | date.day, date.hour << 11 | date.minute << 5 | date.second // 2
 
 
 class Zipper:
-    def zip(self, files, path):
-        with zipfile.ZipFile(path, "w") as zip_file:
-            for file_name, file_bytes in files:
-                zip_file.writestr(file_name, file_bytes)
-        return path
\ No newline at end of file
+    def __init__(self):
+        self.entries = []
+        self.offset = 0
+
+    async def zip(self, files):
+        async for path, date, body in files:
+            async for data in self.entry(path, date, body):
+                yield data
+        yield self.central_directory()
+
+    async def entry(self, path, date, body):
+        name = path.encode("utf-8")
+        date, time = dos_date_time(date)
+        offset = self.offset
+
+        # Sizes and CRC are unknown until the body is streamed, they go in the ZIP64 data descriptor
+        extra = struct.pack("<HHQQ", 0x0001, 16, 0, 0)
+        header = struct.pack("<IHHHHHIIIHH", 0x04034b50, ZIP64_VERSION, FLAGS, 0, time, date, 0, ZIP64_LIMIT, ZIP64_LIMIT, len(name), len(extra))
+        yield self.written(header + name + extra)
+
+        crc = 0
+        size = 0
+        async for data in body:
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+            yield self.written(data)
+
+        yield self.written(struct.pack("<IIQQ", 0x08074b50, crc, size, size))
+        self.entries.append((name, date, time, crc, size, offset))
+
+    def central_directory(self):
+        start = self.offset
+        records = []
+        for name, date, time, crc, size, offset in self.entries:
+            extra = struct.pack("<QQ", size, size)
+            if offset >= ZIP64_LIMIT:
+                extra += struct.pack("<Q", offset)
+            extra = struct.pack("<HH", 0x0001, len(extra)) + extra
+
+            records.append(struct.pack(
+                "<IHHHHHHIIIHHHHHII", 0x02014b50, ZIP64_VERSION, ZIP64_VERSION, FLAGS, 0, time, date, crc,
+                ZIP64_LIMIT, ZIP64_LIMIT, len(name), len(extra), 0, 0, 0, 0o644 << 16, min(offset, ZIP64_LIMIT),
+            ) + name + extra)
+
+        directory = b"".join(records)
+        size = len(directory)
+        end = self.offset + size
+
+        if len(self.entries) >= 0xFFFF or start >= ZIP64_LIMIT or size >= ZIP64_LIMIT:
+            directory += struct.pack("<IQHHIIQQQQ", 0x06064b50, 44, ZIP64_VERSION, ZIP64_VERSION, 0, 0, len(self.entries), len(self.entries), size, start)
+            directory += struct.pack("<IIQI", 0x07064b50, 0, end, 1)
+
+        directory += struct.pack(
+            "<IHHHHIIH", 0x06054b50, 0, 0, min(len(self.entries), 0xFFFF), min(len(self.entries), 0xFFFF),
+            min(size, ZIP64_LIMIT), min(start, ZIP64_LIMIT), 0,
+        )
+        return self.written(directory)
+
+    def written(self, data):
+        self.offset += len(data)
+        return data
@@ -0,0 +1,73 @@
+import hashlib
+import io
+import unittest
+
+from src.chunker import Chunker, ContentDefinedChunker
+
+
+# Deterministic, incompressible input, the same on every run
+DATA = b"".join(hashlib.sha256(index.to_bytes(4, "little")).digest() for index in range(8192))
+
+# Boundaries of DATA with a 4 KB average, stored chunk hashes depend on them so they must never change
+LENGTHS = [
+    2202, 5690, 4564, 4126, 6982, 4367, 4193, 4955, 4141, 6265, 4791, 4562, 4842, 5082, 4515, 5026, 3113, 1043, 5111,
+    6199, 6840, 4813, 1437, 4857, 3151, 3801, 3990, 4153, 4229, 4613, 4126, 4486, 5399, 5867, 5277, 3576, 5706, 4875,
+    4176, 6403, 1499, 5045, 4586, 5489, 5491, 4100, 4931, 7809, 4422, 4207, 4277, 4482, 4535, 5010, 5784, 4976, 1957,
+]
+
+
+def boundaries(data, average_size=4096, read_size=1024 * 1024):
+    return list(ContentDefinedChunker(average_size, 1 << 30, read_size).boundaries(io.BytesIO(data)))
+
+
+class TestContentDefinedChunker(unittest.TestCase):
+    def test_boundaries_are_stable(self):
+        chunks = boundaries(DATA)
+        self.assertEqual([length for start, length, hash_ in chunks], LENGTHS)
+        self.assertEqual(chunks[0][2], "0254a34c01fb0b70c8c97dc7e2fbd4009c5db116ff39ce5c8b2d5a60656d581c")
+        self.assertEqual(chunks[-1][2], "f826abb0882fc6e1b978f373c0474ff0be21bcd03c35fded2f9d19898d30d52c")
+
+    def test_chunks_cover_the_file(self):
+        chunks = boundaries(DATA)
+        position = 0
+        for start, length, hash_ in chunks:
+            self.assertEqual(start, position)
+            self.assertEqual(hash_, hashlib.sha256(DATA[start:start + length]).hexdigest())
+            position += length
+        self.assertEqual(position, len(DATA))
+
+    def test_read_size_does_not_matter(self):
+        expected = boundaries(DATA)
+        for read_size in (37, 1000, 4096, 65536):
+            self.assertEqual(boundaries(DATA, read_size=read_size), expected)
+
+    def test_sizes_stay_within_bounds(self):
+        chunker = ContentDefinedChunker(4096, 1 << 30)
+        lengths = [length for start, length, hash_ in boundaries(DATA + bytes(100000))]
+        self.assertTrue(all(chunker.min_size <= length <= chunker.max_size for length in lengths[:-1]))
+        self.assertLessEqual(lengths[-1], chunker.max_size)
+
+    def test_insertion_only_changes_nearby_chunks(self):
+        # Content shifted by an insertion is cut at the same places, so its chunks are deduplicated
+        hashes = {hash_ for start, length, hash_ in boundaries(DATA)}
+        shifted = [hash_ for start, length, hash_ in boundaries(b"inserted" + DATA)]
+        self.assertGreaterEqual(len(hashes.intersection(shifted)), len(hashes) - 2)
+
+    def test_split_reads_the_chunks(self):
+        chunks = ContentDefinedChunker(4096, 1 << 30).split(io.BytesIO(DATA), "name")
+        self.assertEqual(b"".join(chunk.read() for chunk in chunks), DATA)
+        self.assertTrue(all(chunk.name == "name" for chunk in chunks))
+
+    def test_empty_file(self):
+        self.assertEqual(boundaries(b""), [])
+
+
+class TestChunker(unittest.TestCase):
+    def test_fixed_size(self):
+        chunks = Chunker(1000).split(io.BytesIO(DATA[:2500]))
+        self.assertEqual([chunk.length for chunk in chunks], [1000, 1000, 500])
+        self.assertEqual(b"".join(chunk.read() for chunk in chunks), DATA[:2500])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import unittest
+
+import bson
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import src.handlers.files as handlers_files
+import src.indexes as indexes
+
+
+MONGO_URI = os.environ.get("MONGO_URI")
+
+
+def stages(plan):
+    # Every stage of a plan, nested under inputStage(s) or queryPlan depending on the server version
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan["stage"]
+        for value in plan.values():
+            yield from stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            yield from stages(value)
+
+
+@unittest.skipUnless(MONGO_URI, "MONGO_URI is not set")
+class TestIndexes(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.client = AsyncIOMotorClient(MONGO_URI)
+        self.db = self.client[f"telecloud_test_{bson.ObjectId()}"]
+        await indexes.migrate(self.db)
+
+        # A few documents so the planner compares real candidates instead of an empty collection
+        self.directories = [bson.ObjectId() for _ in range(3)]
+        self.tags = [bson.ObjectId() for _ in range(3)]
+        self.pack = bson.ObjectId()
+        await self.db.directories.insert_many([{"_id": directory, "name": f"directory {index}", "parent": None} for index, directory in enumerate(self.directories)])
+        await self.db.tags.insert_many([{"_id": tag, "name": f"tag {index}", "parent": self.tags[index - 1] if index else None, "ancestors": self.tags[:index]} for index, tag in enumerate(self.tags)])
+        await self.db.files.insert_many([{
+            "name": f"file {index}",
+            "type": "text/plain" if index % 2 else "image/png",
+            "size": index,
+            "tags": [str(self.tags[index % 3])],
+            "directory": self.directories[index % 3] if index % 4 else None,
+            "chunks": [{"pack": self.pack, "offset": 0}] if index % 5 == 0 else [index],
+        } for index in range(50)])
+
+    async def asyncTearDown(self):
+        await self.client.drop_database(self.db.name)
+        self.client.close()
+
+    async def assertIndexed(self, collection, query):
+        explain = await self.db[collection].find(query).explain()
+        plan = list(stages(explain["queryPlanner"]["winningPlan"]))
+        self.assertNotIn("COLLSCAN", plan, f"{collection} {query}: {plan}")
+        self.assertTrue(any(stage in ("IXSCAN", "EXPRESS_IXSCAN") for stage in plan), f"{collection} {query}: {plan}")
+
+    async def test_files_query(self):
+        directories = [str(directory) for directory in self.directories[:2]] + ["/"]
+        tags = [str(tag) for tag in self.tags[:2]]
+        for query in [
+            handlers_files.get_files_query(tags, None, None),
+            handlers_files.get_files_query(None, ["text/plain", "image/png"], None),
+            handlers_files.get_files_query(None, None, directories),
+            handlers_files.get_files_query(tags, ["text/plain"], directories),
+        ]:
+            await self.assertIndexed("files", query)
+
+    async def test_files_query_with_descendants(self):
+        tags = [[str(tag) for tag in self.tags], str(self.tags[1])]
+        await self.assertIndexed("files", handlers_files.get_files_query(tags, None, None))
+        await self.assertIndexed("files", handlers_files.get_files_query(tags, ["text/plain"], [str(self.directories[0])]))
+
+    async def test_duplicate_check(self):
+        for directory in (None, self.directories[1]):
+            await self.assertIndexed("files", {"name": "file 1", "type": "text/plain", "size": 1, "directory": directory})
+
+    async def test_parent_lookups(self):
+        parents = {"$in": self.directories[:2]}
+        await self.assertIndexed("directories", {"parent": parents})
+        await self.assertIndexed("directories", {"name": "directory 1", "parent": None})
+        await self.assertIndexed("tags", {"parent": {"$in": self.tags[:2]}})
+        await self.assertIndexed("tags", {"name": "tag 1", "parent": self.tags[0]})
+
+    async def test_ancestors(self):
+        await self.assertIndexed("tags", {"ancestors": {"$in": self.tags[:2]}})
+        await self.assertIndexed("tags", {"ancestors": self.tags[0]})
+
+    async def test_chunks_pack(self):
+        await self.assertIndexed("files", {"chunks.pack": self.pack})
+
+
+if __name__ == "__main__":
+    unittest.main()
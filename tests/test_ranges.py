@@ -0,0 +1,56 @@
+import datetime as dt
+import unittest
+
+from werkzeug.datastructures import IfRange
+from werkzeug.http import parse_range_header
+
+import src.utils as utils
+
+
+class TestSatisfiableRanges(unittest.TestCase):
+    def ranges(self, header, size=100):
+        return utils.get_satisfiable_ranges(parse_range_header(header), size)
+
+    def test_single_range(self):
+        self.assertEqual(self.ranges("bytes=0-9"), [(0, 10)])
+        self.assertEqual(self.ranges("bytes=90-"), [(90, 100)])
+
+    def test_end_past_the_size_is_clamped(self):
+        self.assertEqual(self.ranges("bytes=50-500"), [(50, 100)])
+
+    def test_suffix_range(self):
+        self.assertEqual(self.ranges("bytes=-10"), [(90, 100)])
+        self.assertEqual(self.ranges("bytes=-500"), [(0, 100)])
+
+    def test_multiple_ranges(self):
+        self.assertEqual(self.ranges("bytes=0-4,10-14,-5"), [(0, 5), (10, 15), (95, 100)])
+
+    def test_unsatisfiable_ranges_are_dropped(self):
+        self.assertEqual(self.ranges("bytes=100-"), [])
+        self.assertEqual(self.ranges("bytes=0-0,200-300"), [(0, 1)])
+        self.assertEqual(self.ranges("bytes=-5", size=0), [])
+
+
+class TestIfRange(unittest.TestCase):
+    last_modified = dt.datetime(2023, 5, 1, 12, 30, 15, 123456)
+
+    def test_missing_header_matches(self):
+        self.assertTrue(utils.if_range_matches(None, "etag", self.last_modified))
+        self.assertTrue(utils.if_range_matches(IfRange(), "etag", self.last_modified))
+
+    def test_etag(self):
+        self.assertTrue(utils.if_range_matches(IfRange(etag="etag"), "etag", self.last_modified))
+        self.assertFalse(utils.if_range_matches(IfRange(etag="other"), "etag", self.last_modified))
+
+    def test_date_is_compared_to_the_second(self):
+        date = dt.datetime(2023, 5, 1, 12, 30, 15, tzinfo=dt.timezone.utc)
+        self.assertTrue(utils.if_range_matches(IfRange(date=date), "etag", self.last_modified))
+        self.assertFalse(utils.if_range_matches(IfRange(date=date + dt.timedelta(seconds=1)), "etag", self.last_modified))
+
+    def test_date_without_last_modified(self):
+        date = dt.datetime(2023, 5, 1, tzinfo=dt.timezone.utc)
+        self.assertFalse(utils.if_range_matches(IfRange(date=date), "etag", None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+import src.scheduler as scheduler
+
+
+class TestScheduler(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        # The scheduler reads its limits from config.yaml in the working directory
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        with open("config.yaml", "w") as config_file:
+            config_file.write("telegram_rate_limits:\n  method: [20, 2]\nflood_recovery_time: 0.2\nflood_min_rate_factor: 0.25\n")
+        self.scheduler = scheduler.Scheduler()
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    async def test_burst_then_rate(self):
+        self.assertEqual(await self.scheduler.acquire("a", "method", scheduler.UPLOAD), 0)
+        self.assertEqual(await self.scheduler.acquire("a", "method", scheduler.UPLOAD), 0)
+
+        started = time.monotonic()
+        await self.scheduler.acquire("a", "method", scheduler.UPLOAD)
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+
+    async def test_sessions_have_their_own_buckets(self):
+        for session in ("a", "a", "b", "b"):
+            self.assertEqual(await self.scheduler.acquire(session, "method", scheduler.UPLOAD), 0)
+
+    async def test_unknown_methods_get_the_default_limit(self):
+        self.assertEqual((self.scheduler.bucket("a", "other").rate, self.scheduler.bucket("a", "other").burst), (5, 10))
+        self.assertEqual(self.scheduler.bucket("a", "send_file").rate, scheduler.RATE_LIMITS["send_file"][0])
+
+    async def test_interactive_calls_go_first(self):
+        await self.scheduler.acquire("a", "method", scheduler.UPLOAD)
+        await self.scheduler.acquire("a", "method", scheduler.UPLOAD)
+
+        order = []
+
+        async def call(name, priority):
+            await self.scheduler.acquire("a", "method", priority)
+            order.append(name)
+
+        background = [asyncio.ensure_future(call(f"background {index}", scheduler.BACKGROUND)) for index in range(2)]
+        await asyncio.sleep(0)
+        interactive = asyncio.ensure_future(call("interactive", scheduler.INTERACTIVE))
+        await asyncio.gather(interactive, *background)
+
+        self.assertEqual(order, ["interactive", "background 0", "background 1"])
+        self.assertGreater(self.scheduler.stats()["wait_time"]["background"], 0)
+
+    async def test_flood_blocks_and_slows_the_bucket(self):
+        self.scheduler.flood("a", "method", 0.1)
+        bucket = self.scheduler.bucket("a", "method")
+        self.assertEqual(bucket.rate, 10)
+        self.assertEqual(bucket.flood_waits, 1)
+
+        started = time.monotonic()
+        await self.scheduler.acquire("a", "method", scheduler.UPLOAD)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+        # Never below flood_min_rate_factor of the limit
+        for _ in range(5):
+            self.scheduler.flood("a", "method", 0)
+        self.assertEqual(bucket.rate, 5)
+
+    async def test_rate_recovers_without_floods(self):
+        self.scheduler.flood("a", "method", 0)
+        bucket = self.scheduler.bucket("a", "method")
+        self.assertEqual(bucket.rate, 10)
+
+        await asyncio.sleep(0.25)
+        self.scheduler.recover(bucket, time.monotonic())
+        self.assertEqual(bucket.rate, 20)
+
+
+class TestBucket(unittest.TestCase):
+    def test_refill_is_capped_by_the_burst(self):
+        bucket = scheduler.Bucket(10, 3)
+        bucket.tokens = 0
+        bucket.refill(bucket.updated + 0.1)
+        self.assertAlmostEqual(bucket.tokens, 1)
+        bucket.refill(bucket.updated + 10)
+        self.assertEqual(bucket.tokens, 3)
+
+    def test_delay(self):
+        bucket = scheduler.Bucket(10, 3)
+        self.assertEqual(bucket.delay(bucket.updated), 0)
+        bucket.tokens = 0.5
+        self.assertAlmostEqual(bucket.delay(bucket.updated), 0.05)
+        bucket.blocked_until = bucket.updated + 2
+        self.assertAlmostEqual(bucket.delay(bucket.updated), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
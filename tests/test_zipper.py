@@ -0,0 +1,50 @@
+import asyncio
+import datetime as dt
+import io
+import unittest
+import zipfile
+
+from src.zipper import Zipper
+
+
+async def body(*parts):
+    for part in parts:
+        yield part
+
+
+async def archive(files):
+    async def entries():
+        for path, date, parts in files:
+            yield path, date, body(*parts)
+
+    return b"".join([data async for data in Zipper().zip(entries())])
+
+
+class TestZipper(unittest.TestCase):
+    def read(self, files):
+        return zipfile.ZipFile(io.BytesIO(asyncio.run(archive(files))))
+
+    def test_entries_round_trip(self):
+        date = dt.datetime(2023, 5, 1, 12, 30, 14)
+        files = [
+            ("a.txt", date, [b"hello ", b"world"]),
+            ("photos/été.jpg", None, [bytes(range(256)) * 100]),
+            ("empty", date, []),
+        ]
+        with self.read(files) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.namelist(), ["a.txt", "photos/été.jpg", "empty"])
+            self.assertEqual(zip_file.read("a.txt"), b"hello world")
+            self.assertEqual(zip_file.read("photos/été.jpg"), bytes(range(256)) * 100)
+            self.assertEqual(zip_file.read("empty"), b"")
+            self.assertEqual(zip_file.getinfo("a.txt").date_time, (2023, 5, 1, 12, 30, 14))
+            # Files without a date get the earliest date a ZIP can hold
+            self.assertEqual(zip_file.getinfo("photos/été.jpg").date_time, (1980, 1, 1, 0, 0, 0))
+
+    def test_empty_archive(self):
+        with self.read([]) as zip_file:
+            self.assertEqual(zip_file.namelist(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()